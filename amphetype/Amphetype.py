@@ -75,7 +75,8 @@ class AmphetypeWindow(QMainWindow):
 
     ph = PerformanceHistory()
     tm.refreshSources.connect(ph.refreshSources)
-    quiz.statsChanged.connect(ph.updateData)
+    quiz.statsChanged.connect(ph.newResults)
+    quiz.statsChanged.connect(tm.statsChanged)
     ph.setText.connect(quiz.setText)
     ph.gotoText.connect(lambda: tabs.setCurrentIndex(0))
     tabs.addTab(ph, "Performance")
@@ -96,7 +97,8 @@ class AmphetypeWindow(QMainWindow):
     tm.setText.connect(tw.setText)
     tw.wantText.connect(tm.nextText)
     tw.wantReview.connect(lg.wantReview)
-    tw.statsChanged.connect(ph.updateData)
+    tw.statsChanged.connect(ph.newResults)
+    tw.statsChanged.connect(tm.statsChanged)
 
     dw = DatabaseWidget()
     tabs.addTab(dw, "Database")
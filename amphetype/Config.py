@@ -63,6 +63,10 @@ class AmphSettings(FSettings, metaclass=SettingsMeta):
     "perf_items": 100,
     "text_regex": r"",
     "db_name": "",  # Will be set in __init__().
+    "db_profile": "fast",
+    "db_cache_mb": 64,
+    "db_mmap_mb": 256,
+    "query_cache_mb": 32,
     "select_method": 0,
     "num_rand": 50,
     "graph_what": 3,
@@ -73,8 +77,11 @@ class AmphSettings(FSettings, metaclass=SettingsMeta):
     "dampen_graph": False,
     "minutes_in_sitting": 60.0,
     "dampen_average": 10,
+    "dampen_kernel": 0,
+    "graph_bands": False,
     "def_group_by": 10,
     "use_lesson_stats": False,
+    "ngram_length": 3,
     "auto_review": False,
     "min_wpm": 0.0,
     "min_acc": 0.0,
@@ -87,6 +94,8 @@ class AmphSettings(FSettings, metaclass=SettingsMeta):
     "group_month": 365.0,
     "group_week": 30.0,
     "group_day": 7.0,
+    "maint_interval": 0.0,  # Days between automatic maintenance runs, 0 for never.
+    "maint_last": 0.0,
     "ana_which": "wpm asc",
     "ana_what": 0,
     "ana_many": 30,
@@ -496,6 +505,12 @@ class GeneralOptions(QWidget):
           ),
           SettingsCheckBox("show_last", "Show last result(s) above text in the Typer."),
           SettingsCheckBox("use_lesson_stats", "Save key/trigram/word statistics from generated lessons."),
+          [
+            "Record n-grams of length",
+            SettingsEdit("ngram_length"),
+            "in Typer 2 (the Analysis tab and text selection only use trigrams).",
+            None,
+          ],
           SettingsCheckBox(
             "req_space",
             "Make SPACE mandatory before each session (Typer 1 ONLY)",
@@ -533,9 +548,9 @@ class GeneralOptions(QWidget):
           ],
           [SettingsCheckBox("break_sentences", "Break long sentences when importing external text."), None],
           [
-            "When selecting easy/difficult texts, pick the best from a sample of",
+            "When selecting easy/difficult texts, pick randomly among the",
             SettingsEdit("num_rand"),
-            "texts.",
+            "easiest/most difficult texts.",
             None,
           ],
           [
@@ -551,7 +566,7 @@ class GeneralOptions(QWidget):
             None,
           ],
           [
-            "When smoothing out the graph, display a running average of",
+            "When smoothing out the graph or showing its spread, use windows of",
             SettingsEdit("dampen_average"),
             "values",
             None,
@@ -1,6 +1,16 @@
 import bisect
+import logging as log
+import queue
+import random
 import sqlite3
 import re
+import sys
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+from itertools import islice
+from pathlib import Path
+from amphetype import cli_options
 from amphetype.Config import Settings
 
 
@@ -34,6 +44,24 @@ def trimmed_average(total, series):
   return s / n
 
 
+def quantile(xs, q):
+  """Linearly interpolated `q`-quantile of `xs`, so that `quantile(xs, 0.5)` is
+  the ordinary median. Returns None for an empty series.
+
+  """
+  n = len(xs)
+  if n == 0:
+    return None
+  # sorted() is C; a Python selection only beats it for millions of values.
+  xs = sorted(xs)
+  pos = min(max(q, 0.0), 1.0) * (n - 1)
+  k = int(pos)
+  frac = pos - k
+  if frac == 0.0:
+    return xs[k]
+  return xs[k] + (xs[k + 1] - xs[k]) * frac
+
+
 class Statistic(list):
   def __init__(self):
     super(Statistic, self).__init__()
@@ -65,13 +93,83 @@ class Statistic(list):
     return self.flawed_
 
 
-class MedianAggregate(Statistic):
+class MedianAggregate(object):
+  def __init__(self):
+    self.vals_ = []
+
   def step(self, val):
     if val is not None:
-      self.append(val)
+      self.vals_.append(val)
+
+  def finalize(self):
+    return quantile(self.vals_, 0.5)
+
+
+class QuantileAggregate(MedianAggregate):
+  def __init__(self):
+    super(QuantileAggregate, self).__init__()
+    self.q_ = 0.5
+
+  def step(self, val, q):
+    if q is not None:
+      self.q_ = q
+    super(QuantileAggregate, self).step(val)
+
+  def finalize(self):
+    return quantile(self.vals_, self.q_)
+
+
+class ApproxQuantileAggregate(QuantileAggregate):
+  """Quantile estimated from a fixed-size uniform sample of the group (reservoir
+  sampling), so memory and finalize() cost stay bounded for huge groups.
+
+  """
+
+  capacity = 2048
+
+  def __init__(self):
+    super(ApproxQuantileAggregate, self).__init__()
+    self.seen_ = 0
+    # Fixed seed so the same query gives the same answer.
+    self.rng_ = random.Random(self.capacity)
+
+  def step(self, val, q):
+    if val is None:
+      return
+    if q is not None:
+      self.q_ = q
+    self.seen_ += 1
+    if len(self.vals_) < self.capacity:
+      self.vals_.append(val)
+    else:
+      i = self.rng_.randrange(self.seen_)
+      if i < self.capacity:
+        self.vals_[i] = val
+
+
+class WeightedMedianAggregate(object):
+  """Median of values that each stand for `weight` samples, e.g. daily means
+  weighted by the number of samples of the day."""
+
+  def __init__(self):
+    self.vals_ = []
+
+  def step(self, val, weight):
+    if val is not None and weight:
+      self.vals_.append((val, weight))
 
   def finalize(self):
-    return self.median()
+    if not self.vals_:
+      return None
+    self.vals_.sort()
+    half = sum(w for _, w in self.vals_) / 2.0
+    acc = 0.0
+    for i, (v, w) in enumerate(self.vals_):
+      acc += w
+      if acc > half:
+        return v
+      if acc == half:
+        return (v + self.vals_[i + 1][0]) / 2.0
 
 
 class MeanAggregate(object):
@@ -93,25 +191,205 @@ class FirstAggregate(object):
     self.val = None
 
   def step(self, val):
-    if self.val is not None:
+    if self.val is None:
       self.val = val
 
   def finalize(self):
     return self.val
 
 
+# Schema migrations. Entry `i` upgrades a database with `PRAGMA user_version` i
+# to version i+1. Only ever append to this list; databases in the wild may be at
+# any version.
+MIGRATIONS = [
+  # 1: indexes for the access paths used by Analysis, Performance and text
+  # selection (history window scans, per-text/per-source results, etc.).
+  """
+create index if not exists statistic_type_data on statistic (type, data);
+create index if not exists statistic_w on statistic (w);
+create index if not exists result_w on result (w);
+create index if not exists result_text_id on result (text_id, wpm);
+create index if not exists result_source on result (source, wpm);
+create index if not exists text_source_disabled on text (source, disabled);
+create index if not exists text_disabled on text (disabled);
+create index if not exists mistake_w on mistake (w);
+analyze;
+""",
+  # 2: per-(type, data, day) summary of `statistic`, kept up to date by
+  # addStatistics(). Sums rather than averages so rows can be merged.
+  """
+create table statistic_day (day integer, type integer, data text, time_sum real, count integer,
+  mistakes integer, visc_sum real, visc_n integer, primary key (type, data, day));
+create index statistic_day_type_day on statistic_day (type, day, data);
+insert into statistic_day (day,type,data,time_sum,count,mistakes,visc_sum,visc_n)
+  select cast(w/86400 as int) as day,type,data,sum(time*count),sum(count),sum(mistakes),
+    coalesce(sum(viscosity),0.0),count(viscosity)
+  from statistic group by day,type,data;
+""",
+  # 3: inverted index of the words in the enabled texts, filled in the
+  # background by indexTexts() and cleaned up by a delete trigger. Texts get a
+  # small integer key of their own: ids are long, and VACUUM may renumber the
+  # rowids of `text`.
+  """
+create table text_key (key integer primary key, id text unique);
+create table text_word (word text, text integer, count integer, primary key (word, text)) without rowid;
+create index text_word_text on text_word (text);
+create trigger text_word_delete after delete on text begin
+  delete from text_word where text = (select key from text_key where id = old.id);
+  delete from text_key where id = old.id;
+end;
+""",
+]
+
+
+def batched(iterable, n):
+  it = iter(iterable)
+  while True:
+    batch = list(islice(it, n))
+    if not batch:
+      return
+    yield batch
+
+
+WORD_RE = re.compile(r"\w+(?:['-]\w+)*")
+
+
+def text_words(text):
+  "Counts of the words of four or more letters in `text`, like `statistic` keeps them."
+  return Counter(w for w in WORD_RE.findall(text) if len(w) >= 4)
+
+
+# The table a data-modifying statement writes to.
+WRITE_RE = re.compile(r"\s*(?:(?:insert|replace|update)(?:\s+or\s+\w+)?(?:\s+into)?|delete\s+from)\s+(\w+)", re.I)
+# Statements that may change the schema; they invalidate every cached query.
+SCHEMA_RE = re.compile(r"\s*(?:create|drop|alter)\b", re.I)
+
+
+def rows_size(rows):
+  "Rough number of bytes taken by a list of result rows, from a sample."
+  if not rows:
+    return sys.getsizeof(rows)
+  sample = rows[:: max(1, len(rows) // 64)]
+  per_row = sum(sys.getsizeof(r) + sum(map(sys.getsizeof, r)) for r in sample) / len(sample)
+  return sys.getsizeof(rows) + int(per_row * len(rows))
+
+
+class QueryCache:
+  """Results of read queries, keyed by SQL and parameters and kept (least
+  recently used first out) within `budget` bytes.
+
+  Each table has a generation counter that `AmphDatabase` bumps whenever a
+  connection writes to it; an entry is only returned while the generations of
+  the tables it was declared to read are unchanged. Triggers aren't seen, so
+  declare the tables a trigger writes through (e.g. `text` for `text_word`).
+
+  The returned rows are shared: don't modify them.
+
+  """
+
+  def __init__(self, budget=32 << 20):
+    self.budget = budget
+    self.size = 0
+    self._entries = OrderedDict()  # key -> (generation, size, rows)
+    self._tables = defaultdict(int)
+    self._epoch = 0  # Bumped for schema changes.
+    self._lock = threading.Lock()
+
+  def generation(self, tables):
+    with self._lock:
+      return (self._epoch,) + tuple(self._tables[t.lower()] for t in tables)
+
+  def bump(self, table=None):
+    "Invalidates the entries reading `table`, or all of them."
+    with self._lock:
+      if table is None:
+        self._epoch += 1
+      else:
+        self._tables[table.lower()] += 1
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.size = 0
+
+  def get(self, tables, sql, args=()):
+    "The cached rows of the query, or `None`."
+    key = (sql, tuple(args))
+    gen = self.generation(tables)
+    with self._lock:
+      e = self._entries.get(key)
+      if e is None:
+        return None
+      if e[0] != gen:
+        self._discard(key)
+        return None
+      self._entries.move_to_end(key)
+      return e[2]
+
+  def put(self, gen, sql, args, rows):
+    """Stores `rows` of a query run at generation `gen` (taken before it ran,
+    so that a write during the query makes the entry stale)."""
+    key = (sql, tuple(args))
+    size = rows_size(rows)
+    with self._lock:
+      self._discard(key)
+      if size > self.budget // 4:
+        return  # Would push out most everything else.
+      self._entries[key] = (gen, size, rows)
+      self.size += size
+      while self.size > self.budget:
+        self._discard(next(iter(self._entries)))
+
+  def fetchall(self, db, tables, sql, args=()):
+    "Like `db.fetchall(sql, args)`, but cached. `tables` are those `sql` reads."
+    rows = self.get(tables, sql, args)
+    if rows is None:
+      gen = self.generation(tables)
+      rows = db.fetchall(sql, args)
+      self.put(gen, sql, args, rows)
+    return rows
+
+  def _discard(self, key):
+    e = self._entries.pop(key, None)
+    if e is not None:
+      self.size -= e[1]
+
+
+# Connection profiles: pragmas set on every connection. "fast" trades a little
+# durability (the last commits may be lost on power failure, never corrupted)
+# for far fewer fsyncs per commit, and lets readers run alongside a writer.
+PROFILES = {
+  "fast": {"journal_mode": "wal", "synchronous": "normal", "temp_store": "memory"},
+  "safe": {"journal_mode": "delete", "synchronous": "full", "temp_store": "default"},
+}
+
+
+def connection_pragmas(profile=None):
+  """The `(pragma, value)` pairs for `profile`, by default the one given on
+  the command line or else in the settings."""
+  profile = profile or cli_options.db_profile or Settings.get("db_profile")
+  if profile not in PROFILES:
+    log.warning("unknown database profile %r, using 'fast'", profile)
+    profile = "fast"
+  pragmas = list(PROFILES[profile].items())
+  pragmas.append(("cache_size", -1024 * Settings.get("db_cache_mb")))  # Negative means KiB.
+  pragmas.append(("mmap_size", 1024 * 1024 * Settings.get("db_mmap_mb") if profile == "fast" else 0))
+  return pragmas
+
+
 class AmphDatabase(sqlite3.Connection):
-  def __init__(self, *args):
-    super(AmphDatabase, self).__init__(*args)
+  def __init__(self, database, *args, **kwargs):
+    super(AmphDatabase, self).__init__(database, *args, **kwargs)
+    self.name_ = database
+    self.pool_ = None
+    self.dirty_ = set()  # Tables written since the last commit.
 
     self.setRegex("")
-    self.resetCounter()
-    self.resetTimeGroup()
-    self.create_function("counter", 0, self.counter)
     self.create_function("regex_match", 1, self.match)
     self.create_function("abbreviate", 2, self.abbreviate)
-    self.create_function("time_group", 2, self.time_group)
     self.create_aggregate("agg_median", 1, MedianAggregate)
+    self.create_aggregate("agg_approx_quantile", 2, ApproxQuantileAggregate)
+    self.create_aggregate("agg_wmedian", 2, WeightedMedianAggregate)
     self.create_aggregate("agg_mean", 2, MeanAggregate)
     self.create_aggregate("agg_first", 1, FirstAggregate)
     # self.create_aggregate("agg_trimavg", 2, TrimmedAverarge)
@@ -121,16 +399,15 @@ class AmphDatabase(sqlite3.Connection):
       self.fetchall("select * from result,source,statistic,text,mistake limit 1")
     except:
       self.newDB()
+    # Only now: switching to WAL writes the file header, after which a new
+    # file's auto_vacuum mode can't be set any more.
+    self.applyProfile()
+    self.migrate()
 
-  def resetTimeGroup(self):
-    self.lasttime_ = 0.0
-    self.timecnt_ = 0
-
-  def time_group(self, d, x):
-    if abs(x - self.lasttime_) >= d:
-      self.timecnt_ += 1
-    self.lasttime_ = x
-    return self.timecnt_
+  def applyProfile(self, profile=None):
+    for k, v in connection_pragmas(profile):
+      self.execute(f"pragma {k} = {v}")
+    log.debug("database %s: journal_mode=%s", self.name_, self.fetchone("pragma journal_mode", ("?",))[0])
 
   def setRegex(self, x):
     self.regex_ = re.compile(x)
@@ -145,15 +422,10 @@ class AmphDatabase(sqlite3.Connection):
       return 1
     return 0
 
-  def counter(self):
-    self._count += 1
-    return self._count
-
-  def resetCounter(self):
-    self._count = -1
-
   def newDB(self):
+    # Incremental auto-vacuum lets maintenance give back free pages without a full VACUUM.
     self.executescript("""
+pragma auto_vacuum = incremental;
 create table source (name text, disabled integer, discount integer);
 create table text (id text primary key, source integer, text text, disabled integer);
 create table result (w real, text_id text, source integer, wpm real, accuracy real, viscosity real);
@@ -164,12 +436,172 @@ create view text_source as
     from text as t left join source as s on (t.source = s.rowid);
     """)
     self.commit()
+    if self.fetchone("pragma auto_vacuum", (0,))[0] != 2:  # incremental
+      log.warning("database %s was created without incremental auto-vacuum", self.name_)
+
+  def pool(self):
+    "The `ConnectionPool` for worker threads using this database file."
+    if self.pool_ is None:
+      self.pool_ = ConnectionPool(self.name_)
+    return self.pool_
+
+  def schemaVersion(self):
+    return self.fetchone("pragma user_version", (0,))[0]
+
+  def migrate(self):
+    version = self.schemaVersion()
+    for v in range(version, len(MIGRATIONS)):
+      log.info("upgrading database schema from version %d to %d", v, v + 1)
+      # executescript() commits any pending transaction first; the explicit
+      # begin/commit makes each step atomic.
+      try:
+        self.executescript("begin;\n%s\npragma user_version = %d;\ncommit;" % (MIGRATIONS[v], v + 1))
+      except sqlite3.Error:
+        self.rollback()
+        raise
+
+  def indexTexts(self, after=0, limit=200):
+    """Adds up to `limit` enabled texts that aren't in the `text_word` index
+    yet, taking them in rowid order from `after`. Returns how many were added
+    (0 once there are none left) and the rowid to continue from. Texts added or
+    enabled behind it are picked up by the next pass from 0."""
+    texts = self.fetchall(
+      """select t.rowid,t.id,t.text from text as t
+      where t.rowid > ? and t.disabled is null and not exists (select 1 from text_key as k where k.id = t.id)
+      order by t.rowid limit ?""",
+      (after, limit),
+    )
+    if not texts:
+      return 0, after
+    self.executemany_("insert or ignore into text_key (id) values (?)", [(id,) for _, id, _ in texts])
+    keys = dict(
+      self.execute(
+        "select id,key from text_key where id in (%s)" % ",".join("?" * len(texts)), [id for _, id, _ in texts]
+      )
+    )
+    rows = sorted((w, keys[id], n) for _, id, text in texts for w, n in text_words(text).items())
+    self.executemany_("insert or replace into text_word (word,text,count) values (?,?,?)", rows)
+    return len(texts), texts[-1][0]
+
+  def textsContaining(self, words, limit=50):
+    """The enabled texts with the most occurrences of `words`, given as `(word,
+    weight)` pairs, as `(id, source, text, score)` rows. The score is the
+    weighted number of occurrences."""
+    words = list(words)
+    if not words:
+      return []
+    return self.fetchall(
+      """with want (word,weight) as (values %s)
+      select t.id,t.source,t.text,sum(g.count*w.weight) as score
+      from want as w join text_word as g on (g.word = w.word)
+        join text_key as k on (k.key = g.text) join text as t on (t.id = k.id)
+      where t.disabled is null
+      group by g.text order by score desc limit ?"""
+      % ",".join(["(?,?)"] * len(words)),
+      [x for word in words for x in word] + [limit],
+    )
 
-  def executemany_(self, *args):
-    super(AmphDatabase, self).executemany(*args)
+  def wordTexts(self, word):
+    "The `(rowid, count)` of each enabled text containing `word`."
+    return self.fetchall(
+      """select t.rowid,g.count
+      from text_word as g join text_key as k on (k.key = g.text) join text as t on (t.id = k.id)
+      where g.word = ? and t.disabled is null""",
+      (word,),
+    )
+
+  def wordCounts(self, words):
+    "Total occurrences in all indexed texts of each of `words` that occurs at all."
+    counts = {}
+    for batch in batched(words, 500):
+      counts.update(
+        self.execute(
+          "select word,sum(count) from text_word where word in (%s) group by word" % ",".join("?" * len(batch)),
+          batch,
+        )
+      )
+    return counts
+
+  def addStatistics(self, vals):
+    """Inserts `(time, viscosity, w, count, mistakes, type, data)` tuples into
+    `statistic` and folds them into the `statistic_day` summary."""
+    self.executemany_(
+      """insert into statistic
+      (time,viscosity,w,count,mistakes,type,data) values (?,?,?,?,?,?,?)""",
+      vals,
+    )
+    self.executemany_(
+      """insert into statistic_day (day,type,data,time_sum,count,mistakes,visc_sum,visc_n)
+      values (cast(?3/86400 as int),?6,?7,?1*?4,?4,?5,coalesce(?2,0.0),?2 is not null)
+      on conflict (type,data,day) do update set
+        time_sum = time_sum + excluded.time_sum,
+        count = count + excluded.count,
+        mistakes = mistakes + excluded.mistakes,
+        visc_sum = visc_sum + excluded.visc_sum,
+        visc_n = visc_n + excluded.visc_n""",
+      vals,
+    )
 
-  def executemany(self, *args):
-    super(AmphDatabase, self).executemany(*args)
+  def rebuildSummary(self, since=0.0, until=None):
+    """Recomputes `statistic_day` from `statistic` for all days from `since` (a
+    timestamp) onwards, or up to and including the day of `until` if given.
+    Needed after statistics are deleted or regrouped."""
+    day = int(since // 86400)
+    last = int(until // 86400) if until is not None else None
+    self.execute("delete from statistic_day where day >= ?1 and (?2 is null or day <= ?2)", (day, last))
+    self.execute(
+      """insert into statistic_day (day,type,data,time_sum,count,mistakes,visc_sum,visc_n)
+      select cast(w/86400 as int) as d,type,data,sum(time*count),sum(count),sum(mistakes),
+        coalesce(sum(viscosity),0.0),count(viscosity)
+      from statistic where w >= ?1 and (?2 is null or w < ?2) group by d,type,data""",
+      (day * 86400.0, (last + 1) * 86400.0 if last is not None else None),
+    )
+
+  def written(self, sql):
+    "Invalidates cached queries on the table that `sql` writes to, if any."
+    m = WRITE_RE.match(sql)
+    if m:
+      self.dirty_.add(m.group(1))
+      CACHE.bump(m.group(1))
+    elif SCHEMA_RE.match(sql):
+      CACHE.bump()
+
+  def execute(self, sql, *args):
+    cur = super(AmphDatabase, self).execute(sql, *args)
+    self.written(sql)
+    return cur
+
+  def executescript(self, script):
+    cur = super(AmphDatabase, self).executescript(script)
+    CACHE.bump()
+    return cur
+
+  def commit(self):
+    super(AmphDatabase, self).commit()
+    # Again, now that other connections can see the changes: a query on one of
+    # them may have cached the old data in the meantime.
+    self.flushDirty()
+
+  def rollback(self):
+    super(AmphDatabase, self).rollback()
+    self.flushDirty()
+
+  def flushDirty(self):
+    for t in self.dirty_:
+      CACHE.bump(t)
+    self.dirty_.clear()
+
+  def fetchcached(self, tables, sql, args=()):
+    "Like `fetchall(sql, args)`, through the query cache (see `QueryCache`)."
+    return CACHE.fetchall(self, tables, sql, args)
+
+  def executemany_(self, sql, *args):
+    super(AmphDatabase, self).executemany(sql, *args)
+    self.written(sql)
+
+  def executemany(self, sql, *args):
+    super(AmphDatabase, self).executemany(sql, *args)
+    self.written(sql)
     # self.commit()
 
   def fetchall(self, *args):
@@ -218,19 +650,115 @@ select T.rowid,T.id,T.source,T.text
     return (texts[0][1:], texts[1][1:], texts[2][1:])
 
 
+class ReadOnlyDatabase(AmphDatabase):
+  "A connection that can only query, for `ConnectionPool.read()`."
+
+  def __init__(self, database, *args, **kwargs):
+    super().__init__(database, *args, **kwargs)
+    self.name_ = self.execute("pragma database_list").fetchone()[2]
+
+  def applyProfile(self, profile=None):
+    # The journal mode belongs to the file; only the writer may change it.
+    for k, v in connection_pragmas(profile):
+      if k != "journal_mode":
+        self.execute(f"pragma {k} = {v}")
+    self.execute("pragma query_only = 1")
+
+  def migrate(self):
+    pass  # The schema is kept up to date by the writers.
+
+
+class ConnectionPool:
+  """Connections to one database for worker threads, so background queries
+  needn't share (and fight over) the GUI's `DB` connection.
+
+  `read()` lends one of up to `readers` read-only connections and `write()`
+  the pool's writer connection, each to one thread at a time:
+
+    with DB.pool().read() as db:
+      rows = db.fetchall(...)
+
+  The writer commits when the block is left, or rolls back on an exception.
+  Connections are opened on first use and kept for reuse.
+
+  The writer serializes the workers' writes among themselves only: the GUI's
+  `DB` connection writes too, and waits for (or makes wait) the pool's writer
+  through SQLite's own locking and busy timeout. So keep write transactions
+  short on both.
+
+  """
+
+  def __init__(self, name, readers=2):
+    self.name = name
+    self._free = threading.BoundedSemaphore(readers)
+    self._idle = queue.SimpleQueue()
+    self._lock = threading.Lock()
+    self._writer = None
+
+  @contextmanager
+  def read(self):
+    with self._free:
+      try:
+        db = self._idle.get_nowait()
+      except queue.Empty:
+        db = connect(self.name, readonly=True)
+      try:
+        yield db
+      finally:
+        db.rollback()  # Don't hold on to an old snapshot (and the WAL with it).
+        self._idle.put(db)
+
+  @contextmanager
+  def write(self):
+    with self._lock:
+      if self._writer is None:
+        self._writer = connect(self.name)
+      try:
+        yield self._writer
+      except BaseException:
+        self._writer.rollback()
+        raise
+      self._writer.commit()
+
+  def close(self):
+    """Closes the idle readers, and the writer once the thread using it (if
+    any) is done with it. Readers in use are left to their threads."""
+    while True:
+      try:
+        self._idle.get_nowait().close()
+      except queue.Empty:
+        break
+    with self._lock:
+      if self._writer is not None:
+        self._writer.close()
+        self._writer = None
+
+
+def connect(name, readonly=False):
+  if readonly:
+    uri = Path(name).resolve().as_uri() + "?mode=ro"
+    return sqlite3.connect(uri, 5, 0, "DEFERRED", False, ReadOnlyDatabase, uri=True)
+  return sqlite3.connect(name, 5, 0, "DEFERRED", False, AmphDatabase)
+
+
 dbname = Settings.get("db_name")
 
+CACHE = QueryCache(1024 * 1024 * Settings.get("query_cache_mb"))
+
 # GLOBAL
-DB = sqlite3.connect(dbname, 5, 0, "DEFERRED", False, AmphDatabase)
+DB = connect(dbname)
 
 
 def switchdb(nn):
   global DB
   DB.commit()
   try:
-    nDB = sqlite3.connect(nn, 5, 0, "DEFERRED", False, AmphDatabase)
+    nDB = connect(nn)
+    if DB.pool_ is not None:
+      DB.pool_.close()
     DB = nDB
+    CACHE.bump()  # Cached rows are of the old file.
   except Exception as e:
-    from PyQt5.QtGui import QMessageBox as qmb
+    from PyQt5.QtWidgets import QMessageBox as qmb
 
     qmb.information(None, "Database Error", "Failed to switch to the new database:\n" + str(e))
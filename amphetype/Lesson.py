@@ -76,7 +76,10 @@ class StringListWidget(QTextEdit):
       for word in words:
         pass
       if w == "e":  # encompassing
-        words = (word for word in words if any(c in word for c in control))
+        words = [word for word in words if any(c in word for c in control)]
+        # Words common in the library come first (the sort is stable).
+        common = DB.wordCounts(words)
+        words.sort(key=lambda word: -common.get(word, 0))
       else:  # similar
         words = filter(
           lambda word: min(editdistance.eval(word, c) / max(len(word), len(c), 1) for c in control) < 0.26, words
@@ -174,7 +177,10 @@ class LessonGenerator(QWidget):
     self.strings.updated.connect(self.generatePreview)
 
   def wantReview(self, words):
+    # Follow the drill with the library text that uses the words the most.
+    texts = DB.textsContaining([(word, 1.0) for word in set(words)], limit=1)
     sentences = self.generateLesson(words)
+    sentences.extend(text for _, _, text, _ in texts)
     self.newReview.emit(" ".join(sentences))
 
   def generatePreview(self):
@@ -1,29 +1,22 @@
 import time
 
-from PyQt5.QtCore import QVariant, pyqtSignal
+import numpy as np
+from PyQt5.QtCore import QModelIndex, Qt, QVariant, pyqtSignal
 from PyQt5.QtWidgets import QComboBox, QWidget
 
 import amphetype.Widgets.Plotters as Plotters
+from amphetype import smoothing
 from amphetype.Config import Settings, SettingsCheckBox, SettingsCombo, SettingsEdit
-from amphetype.Data import DB
+from amphetype.Data import DB, quantile
 from amphetype.QtUtil import AmphBoxLayout, AmphButton, AmphModel, AmphTree
 
 
-def dampen(x, n=10):
-  ret = []
-  s = sum(x[0:n])
-  q = 1 / n
-  for i in range(n, len(x)):
-    ret.append(s * q)
-    s += x[i] - x[i - n]
-  return ret
-
-
 class ResultModel(AmphModel):
   def signature(self):
     self.source = None
     self.data_ = []
     self.hidden = 1
+    self.sorted_by = None  # (column, Qt.SortOrder) the user sorted the view by
     return (["When", "Source", "WPM", "Accuracy", "Viscosity"], [self.formatWhen, None, "%.1f", "%.1f%%", "%.1f"])
 
   def populateData(self, idx):
@@ -35,6 +28,40 @@ class ResultModel(AmphModel):
   def setData(self, d):
     self.data_ = d
     self.reset()
+    if self.sorted_by is not None:
+      self.sort(*self.sorted_by)
+
+  def sort(self, col, order=Qt.AscendingOrder):
+    self.sorted_by = (col, order)
+    super().sort(col, order)
+
+  # The following assume the rows are newest first, i.e. the view isn't sorted.
+
+  def insertTop(self, rows):
+    if not rows:
+      return
+    self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+    self.rows[0:0] = rows
+    self.idxs = {}
+    self.endInsertRows()
+
+  def replaceTop(self, row):
+    "Replaces the top row with `row` and returns a copy of the previous one."
+    old = self.rows[0][:]
+    self.rows[0][: len(row)] = row
+    self.dataChanged.emit(self.index(0, 0, QModelIndex()), self.index(0, self.cols - 1, QModelIndex()))
+    return old
+
+  def truncate(self, n):
+    "Removes all but the first `n` rows and returns the removed ones."
+    if len(self.rows) <= n:
+      return []
+    self.beginRemoveRows(QModelIndex(), n, len(self.rows) - 1)
+    removed = self.rows[n:]
+    del self.rows[n:]
+    self.idxs = {}
+    self.endRemoveRows()
+    return removed
 
   def formatWhen(self, w):
     d = time.time() - w
@@ -69,6 +96,8 @@ class PerformanceHistory(QWidget):
 
     self.editflag = False
     self.model = ResultModel()
+    self.last_w = None  # time of the newest result shown
+    self.tail = []  # `[text_id, w, wpm, accuracy, viscosity]` of each result in the newest group
 
     self.cb_source = QComboBox()
     self.refreshSources()
@@ -83,6 +112,9 @@ class PerformanceHistory(QWidget):
     Settings.signal_for("show_xaxis").connect(self.updateGraph)
     Settings.signal_for("chrono_x").connect(self.updateGraph)
     Settings.signal_for("dampen_graph").connect(self.updateGraph)
+    Settings.signal_for("dampen_kernel").connect(self.updateGraph)
+    Settings.signal_for("dampen_average").connect(self.updateGraph)
+    Settings.signal_for("graph_bands").connect(self.updateGraph)
 
     self.setLayout(
       AmphBoxLayout(
@@ -107,6 +139,9 @@ class PerformanceHistory(QWidget):
             SettingsCheckBox("show_xaxis", "Show X-axis"),
             SettingsCheckBox("chrono_x", "Use time-scaled X-axis"),
             SettingsCheckBox("dampen_graph", "Dampen graph values"),
+            "with a",
+            SettingsCombo("dampen_kernel", ["running average", "exponential average", "running median"]),
+            SettingsCheckBox("graph_bands", "Show spread (25-75%)"),
             None,
           ],
           (self.plot, 1),
@@ -120,21 +155,64 @@ class PerformanceHistory(QWidget):
 
   def updateGraph(self):
     pc = Settings.get("graph_what")
-    y = [x[pc] for x in self.model.rows]
-
-    if Settings.get("chrono_x"):
-      x = [x[1] for x in self.model.rows]
+    # The plot takes its points oldest first so that new ones can be appended,
+    # whatever order the table is sorted in.
+    rows = sorted((r for r in self.model.rows or [] if r[pc] is not None), key=lambda r: r[1])
+    y = np.array([r[pc] for r in rows], dtype=np.float64)
+
+    chrono = Settings.get("chrono_x")
+    if chrono:
+      x = np.array([r[1] for r in rows], dtype=np.float64)
     else:
-      x = list(range(len(y)))
-      x.reverse()
+      x = np.arange(len(y), dtype=np.float64)
 
-    if Settings.get("dampen_graph"):
-      y = dampen(y, Settings.get("dampen_average"))
-      x = dampen(x, Settings.get("dampen_average"))
+    # Windowed statistics are plotted at the average x of their window.
+    n = Settings.get("dampen_average")
+    band = None
+    if Settings.get("graph_bands"):
+      lo, hi = smoothing.bands(y, n)
+      band = (smoothing.moving_average(x, n), lo, hi)
 
-    self.p = Plotters.Plot(x, y)
+    if Settings.get("dampen_graph"):
+      kernel = Settings.get("dampen_kernel")
+      if kernel == 1:
+        y = smoothing.ewma(y, n)
+      else:
+        y = smoothing.rolling_median(y, n) if kernel == 2 else smoothing.moving_average(y, n)
+        x = smoothing.moving_average(x, n)
+
+    self.p = Plotters.Plot(
+      x.tolist(), y.tolist(), left_axis=not chrono, band=band, columns=self.plot.viewport().width()
+    )
     self.plot.setScene(self.p)
 
+  def extendGraph(self, new, replaced, dropped):
+    """Updates the plot for `new` rows (newest first) added at the top of the
+    model, `replaced` being `(old, new)` if the previous top row changed, and
+    the `dropped` oldest rows removed. Rows without a value aren't plotted."""
+    pc = Settings.get("graph_what")
+    dropped = sum(r[pc] is not None for r in dropped)
+    if (
+      Settings.get("dampen_graph")
+      or Settings.get("graph_bands")
+      or len(self.p.x) < 2
+      or dropped >= len(self.p.x)
+      or (replaced is not None and (replaced[0][pc] is None) != (replaced[1][pc] is None))
+    ):
+      return self.updateGraph()
+    chrono = Settings.get("chrono_x")
+    if replaced is not None and replaced[1][pc] is not None:
+      self.p.setLast(replaced[1][1] if chrono else self.p.x[-1], replaced[1][pc])
+    new = [r for r in reversed(new) if r[pc] is not None]
+    if chrono:
+      x = [r[1] for r in new]
+    else:
+      x = [self.p.x[-1] + 1 + i for i in range(len(new))]
+    self.p.append(x, [r[pc] for r in new])
+    self.p.dropFirst(dropped)
+    self.p.redraw()
+    self.plot.fitInView(self.p.sceneRect())
+
   def refreshSources(self):
     self.editflag = True
     self.cb_source.clear()
@@ -147,10 +225,8 @@ class PerformanceHistory(QWidget):
       self.cb_source.addItem(v, QVariant(id))
     self.editflag = False
 
-  def updateData(self, *args):
-    if self.editflag:
-      return
-    where = []
+  def sourceFilter(self, *extra):
+    where = list(extra)
     if self.cb_source.currentIndex() <= 0:
       pass
     elif self.cb_source.currentIndex() == 1:  # last text
@@ -164,43 +240,131 @@ class PerformanceHistory(QWidget):
       where.append("r.source = %d" % s)
 
     if len(where) > 0:
-      where = "where " + " and ".join(where)
-    else:
-      where = ""
-
-    g = Settings.get("perf_group_by")
-    if g == 0:  # no grouping
-      sql = """select text_id,w,s.name,wpm,100.0*accuracy,viscosity
-        from result as r left join source as s on (r.source = s.rowid)
-        %s %s
-        order by w desc limit %d"""
-    elif g:
-      sql = """select agg_first(text_id),avg(r.w) as w,count(r.rowid) || ' result(s)',agg_median(r.wpm),
-            100.0*agg_median(r.accuracy),agg_median(r.viscosity)
-        from result as r left join source as s on (r.source = s.rowid)
-        %s %s
-        order by w desc limit %d"""
+      return "where " + " and ".join(where)
+    return ""
 
-    group = ""
+  def groupedResults(self, where, g):
+    "Subquery of the results matching `where` with their group number `grp`."
+    # Groups are numbered in chronological order by window functions over
+    # `mark`, which is computed per result in the innermost query.
     if g == 1:  # by Settings.get('def_group_by')
-      DB.resetCounter()
-      gn = Settings.get("def_group_by")
-      if gn <= 1:
-        gn = 1
-      group = "group by cast(counter()/%d as int)" % gn
-    elif g == 2:  # by sitting
+      gn = max(1, Settings.get("def_group_by"))
+      mark = "row_number() over (order by r.w) - 1"
+      group = "mark / %d" % gn
+    elif g == 2:  # by sitting, i.e. a new group after every long enough break
       mis = Settings.get("minutes_in_sitting") * 60.0
-      DB.resetTimeGroup()
-      group = "group by time_group(%f, r.w)" % mis
-    elif g == 3:  # by day
-      group = "group by cast((r.w+4*3600)/86400 as int)"
+      mark = "case when r.w - lag(r.w) over (order by r.w) < %f then 0 else 1 end" % mis
+      group = "sum(mark) over (order by w rows unbounded preceding)"
+    else:  # by day
+      mark = "null"
+      group = "cast((w+4*3600)/86400 as int)"
+    return """(select *,%s as grp from
+          (select r.text_id,r.w,r.wpm,r.accuracy,r.viscosity,%s as mark
+            from result as r left join source as s on (r.source = s.rowid)
+            %s))""" % (group, mark, where)
+
+  def joinsGroup(self, g, group, w):
+    "Whether a new result at time `w` belongs to `group`, the newest group."
+    if g == 1:
+      return len(group) < max(1, Settings.get("def_group_by"))
+    elif g == 2:
+      return w - group[-1][1] < Settings.get("minutes_in_sitting") * 60.0
+    return int((w + 4 * 3600) / 86400) == int((group[-1][1] + 4 * 3600) / 86400)
+
+  def groupRow(self, group):
+    "The model row for `group`, computed like the grouped query does."
+    med = lambda i: quantile([r[i] for r in group if r[i] is not None], 0.5)  # noqa: E731
+    acc = med(3)
+    return [
+      group[0][0],
+      sum(r[1] for r in group) / len(group),
+      "%d result(s)" % len(group),
+      med(2),
+      None if acc is None else 100.0 * acc,
+      med(4),
+    ]
 
+  def updateData(self, *args):
+    if self.editflag:
+      return
+    where = self.sourceFilter()
+    g = Settings.get("perf_group_by")
     n = Settings.get("perf_items")
+    self.tail = []
+    if g == 0:  # no grouping
+      sql = """select text_id,w,s.name,wpm,100.0*accuracy,viscosity
+        from result as r left join source as s on (r.source = s.rowid)
+        %s
+        order by w desc limit %d""" % (where, n)
+    else:
+      res = self.groupedResults(where, g)
+      sql = """select agg_first(text_id),avg(w) as w,count(*) || ' result(s)',agg_median(wpm),
+            100.0*agg_median(accuracy),agg_median(viscosity)
+        from %s
+        group by grp
+        order by w desc limit %d""" % (res, n)
+      # Keep the newest group's results around so new ones can be folded in.
+      # Groups are numbered chronologically, so that's the highest numbered.
+      self.tail = [
+        list(r)
+        for r in DB.fetchcached(
+          ["result", "source"],
+          """select text_id,w,wpm,accuracy,viscosity
+          from (select *,max(grp) over () as last from %s)
+          where grp = last order by w"""
+          % res,
+        )
+      ]
+
+    self.model.setData(list(map(list, DB.fetchcached(["result", "source"], sql))))
+    self.last_w = DB.fetchcached(
+      ["result", "source"],
+      "select max(r.w) from result as r left join source as s on (r.source = s.rowid) %s" % where,
+    )[0][0]
+    self.updateGraph()
 
-    sql = sql % (where, group, n)
+  def newResults(self):
+    """Adds the results newer than those shown to the top of the list and the
+    end of the plot, rather than reloading everything."""
+    if self.editflag:
+      return
+    if self.cb_source.currentIndex() == 1 or self.last_w is None or self.model.rows is None or self.model.sorted_by:
+      # The <LAST TEXT> filter changes meaning with every new result, and new
+      # rows can't just go on top of a sorted table.
+      return self.updateData()
+
+    new = DB.fetchall(
+      """select text_id,w,s.name,wpm,accuracy,viscosity
+      from result as r left join source as s on (r.source = s.rowid)
+      %s order by w"""
+      % self.sourceFilter("r.w > ?"),
+      (self.last_w,),
+    )
+    if not new:
+      return
+    self.last_w = new[-1][1]
 
-    self.model.setData(list(map(list, DB.fetchall(sql))))
-    self.updateGraph()
+    g = Settings.get("perf_group_by")
+    replaced = None
+    if g == 0:
+      rows = [[text_id, w, name, wpm, 100.0 * acc, visc] for text_id, w, name, wpm, acc, visc in reversed(new)]
+    else:
+      # Fold the new results into the newest group or start new ones.
+      groups = [self.tail] if self.tail else []
+      for text_id, w, _, wpm, acc, visc in new:
+        if groups and self.joinsGroup(g, groups[-1], w):
+          groups[-1].append([text_id, w, wpm, acc, visc])
+        else:
+          groups.append([[text_id, w, wpm, acc, visc]])
+      rows = [self.groupRow(x) for x in reversed(groups)]
+      if groups[0] is self.tail and self.model.rows:
+        row = rows.pop()
+        replaced = (self.model.replaceTop(row), row)
+      self.tail = groups[-1]
+
+    self.model.insertTop(rows)
+    dropped = self.model.truncate(Settings.get("perf_items"))
+    self.extendGraph(rows, replaced, dropped)
 
   def doubleClicked(self, idx):
     r = self.model.rows[idx.row()]
@@ -37,11 +37,21 @@ class WWLabel(QLabel):
 
 
 class AmphModel(QAbstractItemModel):
+  """Tree model over nested lists of rows, loaded level by level through
+  `populateData()`. Models that set `page_size` and implement
+  `populatePage()` instead have their levels loaded a page at a time as the
+  view scrolls, and sorted by the database (see `orderBy()`).
+
+  """
+
   def __init__(self, *args):
     super(AmphModel, self).__init__(*args)
     self.hidden = 0
     self.levels = 2
     self.rows = None
+    self.page_size = None
+    self.order = None  # (column, Qt.SortOrder) for paged models
+    self.more = {}  # index list -> whether that level may have more rows to fetch
     self.head, self.fmt = self.signature()
     self.cols = len(self.head)
     self.idxs = {}
@@ -78,19 +88,42 @@ class AmphModel(QAbstractItemModel):
       return ()
     return index.internalPointer() + (index.row(),)
 
+  def loadList(self, idxs):
+    rows = None
+    if self.page_size:
+      rows = self.populatePage(idxs, 0, self.page_size)
+    if rows is None:
+      return self.populateData(idxs)
+    self.more[idxs] = len(rows) >= self.page_size
+    return rows
+
   def findList(self, parent):
     if not parent.isValid():
       if self.rows is None:
-        self.rows = self.populateData([])
+        self.rows = self.loadList(())
       return self.rows
 
     tab = self.findList(parent.parent())
     row = parent.row()
     r = tab[row]
     if len(r) <= self.cols + self.hidden:
-      r.append(self.populateData(self.indexList(parent)))
+      r.append(self.loadList(self.indexList(parent)))
     return r[self.cols + self.hidden]
 
+  def canFetchMore(self, parent):
+    return self.more.get(self.indexList(parent), False)
+
+  def fetchMore(self, parent):
+    idxs = self.indexList(parent)
+    tab = self.findList(parent)
+    rows = self.populatePage(idxs, len(tab), self.page_size)
+    self.more[idxs] = len(rows) >= self.page_size
+    if not rows:
+      return
+    self.beginInsertRows(parent, len(tab), len(tab) + len(rows) - 1)
+    tab.extend(rows)
+    self.endInsertRows()
+
   def rowCount(self, index=QModelIndex()):
     tab = self.findList(index)
     return len(tab)
@@ -131,6 +164,10 @@ class AmphModel(QAbstractItemModel):
     return QVariant(self.head[section])
 
   def sort(self, col, order=Qt.AscendingOrder):
+    if self.page_size:
+      self.order = (col, order)
+      self.reset()
+      return
     self.beginResetModel()
     reverse = order != Qt.AscendingOrder
     self.rows.sort(key=cmp_to_key(maybe_cmp_func(lambda z: z[col + self.hidden])), reverse=reverse)
@@ -139,13 +176,28 @@ class AmphModel(QAbstractItemModel):
 
   def reset(self):
     self.beginResetModel()
-    self.rows = self.populateData(())
+    self.more = {}
+    self.rows = self.loadList(())
     self.idxs = {}
     self.endResetModel()
 
   def populateData(self, idxs):
     pass
 
+  def populatePage(self, idxs, offset, limit):
+    "Returns up to `limit` rows of a level starting at `offset`, or None if the level isn't paged."
+    return None
+
+  def orderBy(self, default):
+    """ORDER BY clause for `populatePage()` queries whose result columns are the
+    model's columns (hidden ones included) in order. Rows are ordered by the
+    column the view is sorted by, then by `default`, which should make the
+    order unique so that pages don't overlap."""
+    if self.order is None:
+      return "order by " + default
+    col, order = self.order
+    return "order by %d %s, %s" % (col + self.hidden + 1, "asc" if order == Qt.AscendingOrder else "desc", default)
+
   def signature(self):
     return ([], [])
 
@@ -9,6 +9,7 @@ from PyQt5.QtWidgets import QLabel, QTextEdit, QVBoxLayout, QWidget
 from amphetype import timer
 from amphetype.Config import Settings
 from amphetype.Data import DB, Statistic
+from amphetype.latency import LatencyOverlay, timed
 from amphetype.QtUtil import WWLabel
 
 
@@ -22,16 +23,20 @@ class Typer(QTextEdit):
     self.setPalettes()
 
     self.textChanged.connect(self.checkText)
+    self.document().contentsChange.connect(self.contentsChange)
     # self.setLineWrapMode(QTextEdit.NoWrap)
     Settings.signal_for("quiz_wrong_fg").connect(self.setPalettes)
     Settings.signal_for("quiz_wrong_bg").connect(self.setPalettes)
     Settings.signal_for("quiz_right_fg").connect(self.setPalettes)
     Settings.signal_for("quiz_right_bg").connect(self.setPalettes)
     self.target = None
+    self.where = 0
+    self.changed = 0
 
   def sizeHint(self):
     return QSize(600, 10)
 
+  @timed("keystroke (Typer 1)")
   def keyPressEvent(self, e):
     if e.key() == Qt.Key_Escape:
       self.sigCancel.emit()
@@ -54,6 +59,7 @@ class Typer(QTextEdit):
     self.mistake = [False] * len(self.target)
     self.mistakes = {}  # collections.defaultdict(lambda: [])
     self.where = 0
+    self.changed = 0
     self.clear()
     # self.setPalette(self.palettes['inactive'])
     self.setStyleSheet(self._css["inactive"])
@@ -70,19 +76,34 @@ class Typer(QTextEdit):
     else:
       return "Press ESCAPE to restart with a new text at any time"
 
+  def contentsChange(self, pos, removed, added):
+    # Remember the earliest edited position since the last check.
+    self.changed = min(self.changed, pos)
+
+  def charAt(self, pos):
+    "Character at `pos` as it would appear in `toPlainText()`."
+    c = self.document().characterAt(pos)
+    if c in "\u2029\u2028":
+      return "\n"
+    if c == "\u00a0":
+      return " "
+    return c
+
+  @timed("checkText")
   def checkText(self):
     if self.target is None or self.editflag:
       return
 
-    v = str(self.toPlainText())
+    n = self.document().characterCount() - 1
     if self.when[0] == 0:
-      space = len(v) > 0 and v[-1] == " "
+      space = n > 0 and self.charAt(n - 1) == " "
       req = Settings.get("req_space")
 
       self.editflag = True
       if space:
         self.when[0] = timer()
         self.clear()
+        self.where = 0
         # self.setPalette(self.palettes['right'])
         self.setStyleSheet(self._css["right"])
       elif req:
@@ -95,27 +116,29 @@ class Typer(QTextEdit):
       else:
         self.when[0] = -1
 
-    y = 0
-    for y in range(min(len(v), len(self.target)), -1, -1):
-      if v[0:y] == self.target[0:y]:
-        break
-    lcd = v[0:y]
+    # Text before the first edit is unchanged, so the matched prefix can only
+    # have changed from there on. Typing at the end thus costs O(1).
+    y = min(self.where, self.changed, n)
+    m = min(n, len(self.target))
+    while y < m and self.charAt(y) == self.target[y]:
+      y += 1
     self.where = y
+    self.changed = n
 
-    if self.when[y] == 0 and y == len(v):
+    if self.when[y] == 0 and y == n:
       self.when[y] = timer()
       if y > 0:
         self.times[y - 1] = self.when[y] - self.when[y - 1]
 
-    if lcd == self.target:
+    if y == len(self.target):
       self.sigDone.emit()
       return
 
-    if y < len(v) and y < len(self.target):
+    if y < n and y < len(self.target):
       self.mistake[y] = True
-      self.mistakes[y] = self.target[y] + v[y]
+      self.mistakes[y] = self.target[y] + self.charAt(y)
 
-    if v == lcd:
+    if n == y:
       # self.setPalette(self.palettes['right'])
       self.setStyleSheet(self._css["right"])
     else:
@@ -142,6 +165,53 @@ class Typer(QTextEdit):
     return self.when[self.where] - self.when[0], self.where, self.times, self.mistake, self.getMistakes()
 
 
+def run_statistics(text, times, mis, spc, now):
+  """Per-key, per-trigram and per-word statistics of a run through `text`,
+  from the per-character `times` and mistake flags `mis` and the average
+  seconds per character `spc`, as rows for `AmphDatabase.addStatistics()`."""
+  stats = collections.defaultdict(Statistic)
+  visc = collections.defaultdict(Statistic)
+
+  for c, t, m in zip(text, times, mis):
+    stats[c].append(t, m)
+    visc[c].append(((t - spc) / spc) ** 2)
+
+  def gen_tup(s, e):
+    perch = sum(times[s:e]) / (e - s)
+    if perch < 1e-7:
+      log.warning(f"timing for span ({s},{e}) summed to zero or near-zero ({perch}); skipping it")
+      return (None, None, None, None)
+    visc = sum([((x - perch) / perch) ** 2 for x in times[s:e]]) / (e - s)
+    return (text[s:e], perch, len([_f for _f in mis[s:e] if _f]), visc)
+
+  for tri, t, m, v in [gen_tup(i, i + 3) for i in range(0, len(text) - 2)]:
+    if tri is None:
+      continue
+    stats[tri].append(t, m > 0)
+    visc[tri].append(v)
+
+  regex = re.compile(r"(\w|'(?![A-Z]))+(-\w(\w|')*)*")
+
+  for w, t, m, v in [gen_tup(*x.span()) for x in regex.finditer(text) if x.end() - x.start() > 3]:
+    if w is None:
+      continue
+    stats[w].append(t, m > 0)
+    visc[w].append(v)
+
+  def type(k):
+    if len(k) == 1:
+      return 0
+    elif len(k) == 3:
+      return 1
+    return 2
+
+  vals = []
+  for k, s in stats.items():
+    v = visc[k].median()
+    vals.append((s.median(), v * 100.0, now, len(s), s.flawed(), type(k), k))
+  return vals
+
+
 class Quizzer(QWidget):
   wantReview = pyqtSignal("PyQt_PyObject")
   wantText = pyqtSignal()
@@ -152,6 +222,7 @@ class Quizzer(QWidget):
 
     self.result = QLabel()
     self.typer = Typer()
+    self.latency = LatencyOverlay(self.typer)
     self.label = WWLabel()
     self.result.setVisible(Settings.get("show_last"))
     # self.label.setFrameStyle(QFrame.Raised | QFrame.StyledPanel)
@@ -215,56 +286,12 @@ class Quizzer(QWidget):
 
     self.statsChanged.emit()
 
-    stats = collections.defaultdict(Statistic)
-    visc = collections.defaultdict(Statistic)
-    text = self.text[2]
-
-    for c, t, m in zip(text, times, mis):
-      stats[c].append(t, m)
-      visc[c].append(((t - spc) / spc) ** 2)
-
-    def gen_tup(s, e):
-      perch = sum(times[s:e]) / (e - s)
-      if perch < 1e-7:
-        log.warning(f"timing for span ({s},{e}) summed to zero or near-zero ({perch}); skipping it")
-        return (None, None, None, None)
-      visc = sum([((x - perch) / perch) ** 2 for x in times[s:e]]) / (e - s)
-      return (text[s:e], perch, len([_f for _f in mis[s:e] if _f]), visc)
-
-    for tri, t, m, v in [gen_tup(i, i + 3) for i in range(0, chars - 2)]:
-      if tri is None:
-        continue
-      stats[tri].append(t, m > 0)
-      visc[tri].append(v)
-
-    regex = re.compile(r"(\w|'(?![A-Z]))+(-\w(\w|')*)*")
-
-    for w, t, m, v in [gen_tup(*x.span()) for x in regex.finditer(text) if x.end() - x.start() > 3]:
-      if w is None:
-        continue
-      stats[w].append(t, m > 0)
-      visc[w].append(v)
-
-    def type(k):
-      if len(k) == 1:
-        return 0
-      elif len(k) == 3:
-        return 1
-      return 2
-
-    vals = []
-    for k, s in stats.items():
-      v = visc[k].median()
-      vals.append((s.median(), v * 100.0, now, len(s), s.flawed(), type(k), k))
+    vals = run_statistics(self.text[2], times, mis, spc, now)
 
     is_lesson = DB.fetchone("select discount from source where rowid=?", (None,), (self.text[1],))[0]
 
     if Settings.get("use_lesson_stats") or not is_lesson:
-      DB.executemany_(
-        """insert into statistic
-        (time,viscosity,w,count,mistakes,type,data) values (?,?,?,?,?,?,?)""",
-        vals,
-      )
+      DB.addStatistics(vals)
       DB.executemany_(
         "insert into mistake (w,target,mistake,count) values (?,?,?,?)",
         [(now, k[0], k[1], v) for k, v in mistakes.items()],
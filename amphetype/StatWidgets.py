@@ -1,10 +1,13 @@
+import logging as log
+import sqlite3
+import threading
 import time
 
-from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
 from PyQt5.QtWidgets import QWidget
 
 from amphetype.Config import Settings, SettingsCombo, SettingsEdit
-from amphetype.Data import DB
+from amphetype.Data import CACHE, DB
 from amphetype.QtUtil import AmphBoxLayout, AmphButton, AmphModel, AmphTree
 
 # from amphetype.Text import LessonGeneratorPlain
@@ -29,6 +32,63 @@ class WordModel(AmphModel):
     self.reset()
 
 
+class QueryToken:
+  """Lets the GUI cancel a query running on a worker thread: `cancel()`
+  interrupts the connection the query is running on, if it has started."""
+
+  def __init__(self):
+    self.cancelled = False
+    self._db = None
+    self._lock = threading.Lock()
+
+  def attach(self, db):
+    "Called by the worker around its query; returns False if already cancelled."
+    with self._lock:
+      self._db = db
+      return not self.cancelled
+
+  def cancel(self):
+    with self._lock:
+      self.cancelled = True
+      if self._db is not None:
+        self._db.interrupt()
+
+
+class QuerySignals(QObject):
+  done = pyqtSignal("PyQt_PyObject")
+
+
+class Query(QRunnable):
+  """Runs `sql`, which reads `tables`, on a read connection from `pool` in a
+  worker thread, through the query cache. Emits `signals.done` with the rows,
+  or `None` if it was cancelled or failed."""
+
+  def __init__(self, pool, tables, sql, args=()):
+    super().__init__()
+    self.signals = QuerySignals()
+    self.token = QueryToken()
+    self._pool = pool
+    self._tables = tables
+    self._sql = sql
+    self._args = args
+
+  def run(self):
+    rows = None
+    try:
+      with self._pool.read() as db:
+        try:
+          if self.token.attach(db):
+            rows = db.fetchcached(self._tables, self._sql, self._args)
+        finally:
+          self.token.attach(None)
+    except sqlite3.OperationalError:
+      if not self.token.cancelled:
+        log.exception("analysis query failed")
+    except Exception:
+      log.exception("analysis query failed")
+    self.signals.done.emit(rows)
+
+
 class StringStats(QWidget):
   lessonStrings = pyqtSignal("PyQt_PyObject")
 
@@ -36,6 +96,9 @@ class StringStats(QWidget):
     super(StringStats, self).__init__(*args)
 
     self.model = WordModel()
+    self.query_ = None  # The query whose result we're waiting for.
+    self.pending_ = set()  # Keeps running queries (and their signals) alive.
+    self.workers_ = QThreadPool(self, maxThreadCount=2)
     tw = AmphTree(self.model)
     tw.setIndentation(0)
     tw.setUniformRowHeights(True)
@@ -91,17 +154,39 @@ class StringStats(QWidget):
     cat = Settings.get("ana_what")
     limit = Settings.get("ana_many")
     count = Settings.get("ana_count")
-    hist = time.time() - Settings.get("history") * 86400.0
+    hist = int((time.time() - Settings.get("history") * 86400.0) // 86400)
 
     sql = """select data,12.0/time as wpm,
       100.0-100.0*misses/cast(total as real) as accuracy,
       viscosity,total,misses,
       total*time*time*(1.0+misses/total) as damage
         from
-          (select data,agg_median(time) as time,agg_median(viscosity) as viscosity,
+          (select data,agg_wmedian(time_sum/count,count) as time,
+          agg_wmedian(visc_sum/visc_n,visc_n) as viscosity,
           sum(count) as total,sum(mistakes) as misses
-          from statistic where w >= ? and type = ? group by data)
+          from statistic_day where day >= ? and type = ? group by data)
         where total >= ?
         order by %s limit %d""" % (ord, limit)
 
-    self.model.setData(DB.fetchall(sql, (hist, cat, count)))
+    # A query for stale settings is no longer wanted.
+    if self.query_ is not None:
+      self.query_.token.cancel()
+      self.query_ = None
+
+    args = (hist, cat, count)
+    rows = CACHE.get(["statistic_day"], sql, args)
+    if rows is not None:
+      self.model.setData(rows)
+      return
+    q = self.query_ = Query(DB.pool(), ["statistic_day"], sql, args)
+    q.signals.done.connect(lambda rows: self.queryDone(q, rows))
+    self.pending_.add(q)
+    self.workers_.start(q)
+
+  def queryDone(self, query, rows):
+    self.pending_.discard(query)
+    if query is not self.query_:
+      return
+    self.query_ = None
+    if rows is not None:
+      self.model.setData(rows)
@@ -1,10 +1,18 @@
 import logging as log
+import multiprocessing
 import os.path as path
-import time
-import hashlib
-
-from amphetype.Text import LessonMiner
-from amphetype.Data import DB
+import queue
+import random
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from amphetype import timer
+from amphetype.textsplit import init_worker, mine_file, text_id
+from amphetype.difficulty import DifficultyEstimator, WeaknessTargeter
+from amphetype.maintenance import TextIndexer
+from amphetype.Data import DB, batched
+from amphetype.StatWidgets import Query
 from amphetype.QtUtil import (
   AmphModel,
   AmphTree,
@@ -15,24 +23,68 @@ from amphetype.QtUtil import (
 from amphetype.Config import Settings, SettingsEdit, SettingsCombo
 
 
-from PyQt5.QtCore import Qt, pyqtSignal
-from PyQt5.QtWidgets import QWidget, QProgressBar, QBoxLayout, QFileDialog, QMessageBox
+from PyQt5.QtCore import Qt, QThreadPool, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QApplication, QWidget, QProgressBar, QBoxLayout, QFileDialog, QMessageBox
+
+
+class TextSampler(object):
+  """Picks random enabled texts without sorting the text table.
+
+  Keeps the rowids of all enabled texts in a compact array that is reloaded
+  lazily after `invalidate()`, which must be called whenever texts are added,
+  removed, enabled or disabled.
+
+  """
+
+  def __init__(self):
+    self.rowids = None
+
+  def invalidate(self):
+    self.rowids = None
+
+  def refresh(self):
+    self.rowids = array("q", (r for (r,) in DB.execute("select rowid from text where disabled is null")))
+
+  def __len__(self):
+    if self.rowids is None:
+      self.refresh()
+    return len(self.rowids)
+
+  def sample(self, k):
+    "Returns up to `k` random `(id, source, text)` rows."
+    n = len(self)
+    if n == 0:
+      return []
+    picks = [self.rowids[i] for i in random.sample(range(n), min(k, n))]
+    rows = dict(
+      (r[0], r[1:])
+      for r in DB.execute(
+        "select rowid,id,source,text from text where rowid in (%s) and disabled is null" % ",".join("?" * len(picks)),
+        picks,
+      )
+    )
+    if len(rows) < len(picks):
+      self.invalidate()  # Table changed behind our back.
+    return [rows[r] for r in picks if r in rows]
 
 
 class SourceModel(AmphModel):
   def signature(self):
     self.hidden = 1
+    self.page_size = 500
     return (
       ["Source", "Length", "Results", "WPM", "Disabled"],
       [None, None, None, "%.1f", None],
     )
 
-  def populateData(self, idxs):
+  def populatePage(self, idxs, offset, limit):
     if len(idxs) == 0:
       return list(
         map(
           list,
-          DB.fetchall("""
+          DB.fetchcached(
+            ["source", "text", "result"],
+            """
       select s.rowid,s.name,t.count,r.count,r.wpm,ifelse(nullif(t.dis,t.count),'No','Yes')
           from source as s
           left join (select source,count(*) as count,count(disabled) as dis from text group by source) as t
@@ -40,7 +92,10 @@ class SourceModel(AmphModel):
           left join (select source,count(*) as count,avg(wpm) as wpm from result group by source) as r
             on (t.source = r.source)
           where s.disabled is null
-          order by s.name"""),
+          %s limit ? offset ?"""
+            % self.orderBy("s.name,s.rowid"),
+            (limit, offset),
+          ),
         )
       )
 
@@ -49,16 +104,21 @@ class SourceModel(AmphModel):
 
     r = self.rows[idxs[0]]
 
+    # Results are looked up per text through the result_text_id index, so only
+    # the texts on this page (or being sorted) are aggregated.
     return list(
       map(
         list,
-        DB.fetchall(
-          """select t.rowid,substr(t.text,0,40)||"...",length(t.text),r.count,r.m,ifelse(t.disabled,'Yes','No')
-        from (select rowid,* from text where source = ?) as t
-        left join (select text_id,count(*) as count,agg_median(wpm) as m from result group by text_id) as r
-          on (t.id = r.text_id)
-        order by t.rowid""",
-          (r[0],),
+        DB.fetchcached(
+          ["text", "result"],
+          """select t.rowid,substr(t.text,0,40)||"...",length(t.text),
+          nullif((select count(*) from result where text_id = t.id),0),
+          (select agg_median(wpm) from result where text_id = t.id),
+          ifelse(t.disabled,'Yes','No')
+        from text as t where t.source = ?
+        %s limit ? offset ?"""
+          % self.orderBy("t.rowid"),
+          (r[0], limit, offset),
         ),
       )
     )
@@ -80,7 +140,16 @@ Good luck!""",
   def __init__(self, *args):
     super(TextManager, self).__init__(*args)
 
-    self.diff_eval = lambda x: 1
+    self.sampler = TextSampler()
+    self.difficulty = DifficultyEstimator()
+    self.difficulty.setHistory(Settings.get("history"))
+    self.targeter = WeaknessTargeter(self.difficulty)
+    self.targeter.setHistory(Settings.get("history"))
+    self.workers_ = QThreadPool(self, maxThreadCount=2)
+    self.weakness_query_ = None  # The query whose result the targeter is waiting for.
+    self.indexer_ = None  # The running TextIndexer, if any.
+    self.reindex_ = False  # Whether texts changed while it ran.
+    self.pending_ = set()  # Keeps running queries (and their signals) alive.
     self.model = SourceModel()
     tv = AmphTree(self.model)
     tv.doubleClicked["QModelIndex"].connect(self.onDoubleClicked)
@@ -92,6 +161,10 @@ Good luck!""",
     self.progress.setRange(0, 100)
     self.progress.hide()
 
+    self.import_ = None  # State of the running import, if any; see setImpList().
+    self.import_button = AmphButton("Import Texts", self.addFiles)
+    self.import_timer = QTimer(self, timeout=self.importChunks, interval=20)
+
     self.setLayout(
       AmphBoxLayout(
         [
@@ -101,7 +174,7 @@ Good luck!""",
               (self.tree, 1),
               self.progress,
               [
-                AmphButton("Import Texts", self.addFiles),
+                self.import_button,
                 None,
                 AmphButton("Enable All", self.enableAll),
                 AmphButton("Delete Disabled", self.removeDisabled),
@@ -121,11 +194,11 @@ Good luck!""",
               "Selection method for new lessons:",
               SettingsCombo(
                 "select_method",
-                ["Random", "In Order", "Difficult", "Easy"],
+                ["Random", "In Order", "Difficult", "Easy", "Targeted"],
               ),
               None,
             ],
-            "(in order works by selecting the next text after the one you completed last, in the order they were added to the database, easy/difficult works by estimating your WPM for several random texts and choosing the fastest/slowest)\n",
+            "(in order works by selecting the next text after the one you completed last, in the order they were added to the database, easy/difficult works by estimating your WPM for every text and choosing among the fastest/slowest, targeted chooses among the texts with the most of your most damaging keys, trigrams and words)\n",
             20,
             AmphGridLayout(
               [
@@ -156,48 +229,75 @@ Good luck!""",
 
     Settings.signal_for("select_method").connect(self.setSelect)
     Settings.signal_for("text_force_ascii").connect(self.nextText)
-    self.setSelect(Settings.get("select_method"))
+    Settings.signal_for("history").connect(self.difficulty.setHistory)
+    Settings.signal_for("history").connect(self.targeter.setHistory)
+    Settings.signal_for("history").connect(self.refreshWeaknesses)
+    QApplication.instance().aboutToQuit.connect(self.stopIndexing)
+    self.refreshWeaknesses()
+    self.indexTexts()
+    self.nextText()
 
   def setSelect(self, v):
-    if v == 0 or v == 1:
-      self.diff_eval = lambda x: 1
-      self.nextText()
-      return
-
-    hist = time.time() - 86400.0 * Settings.get("history")
-    tri = dict(
-      DB.execute(
-        """
-          select data,agg_median(time) as wpm from statistic
-          where w >= ? and type = 1
-          group by data""",
-        (hist,),
-      ).fetchall()
-    )  # [(t, (m, c)) for t, m, c in
-
-    g = list(tri.values())
-    if len(g) == 0:
-      return lambda x: 1
-    g.sort(reverse=True)
-    expect = g[len(g) // 4]
-
-    def _func(v):
-      text = v[2]
-      v = 0
-      s = 0.0
-      for i in range(0, len(text) - 2):
-        t = text[i : i + 3]
-        if t in tri:
-          s += tri[t]
-        else:
-          s += expect
-          v += 1
-      avg = s / (len(text) - 2)
-      return 12.0 / avg
-
-    self.diff_eval = _func
+    self.refreshWeaknesses()
     self.nextText()
 
+  def textsChanged(self):
+    "Must be called whenever enabled texts are added or removed, or texts enabled or disabled."
+    self.sampler.invalidate()
+    self.difficulty.invalidateTexts()
+    self.targeter.invalidateTexts()
+    self.indexTexts()
+
+  def statsChanged(self):
+    self.difficulty.invalidateScores()
+    self.refreshWeaknesses()
+
+  def refreshWeaknesses(self):
+    """Has the targeter's weaknesses recomputed on a worker, if it's in use.
+    Meanwhile it keeps using the previous ones."""
+    if Settings.get("select_method") != 4:
+      return
+    if self.weakness_query_ is not None:
+      self.weakness_query_.token.cancel()
+    q = self.weakness_query_ = Query(DB.pool(), *self.targeter.weaknessQuery())
+    q.signals.done.connect(lambda rows: self.weaknessesDone(q, rows))
+    self.pending_.add(q)
+    self.workers_.start(q)
+
+  def weaknessesDone(self, query, rows):
+    self.pending_.discard(query)
+    if query is not self.weakness_query_:
+      return
+    self.weakness_query_ = None
+    if rows is not None:
+      self.targeter.setWeaknesses(rows)
+
+  def indexTexts(self):
+    """Has the texts missing from the word index added on a worker. Runs don't
+    overlap, and wait for a running import to finish: a request meanwhile
+    starts another run at the end."""
+    if self.indexer_ is not None or self.import_ is not None:
+      self.reindex_ = True
+      return
+    self.reindex_ = False
+    DB.commit()  # The worker's connection only sees committed texts.
+    self.indexer_ = TextIndexer(DB)
+    self.indexer_.signals.done.connect(self.indexDone)
+    self.workers_.start(self.indexer_)
+
+  def stopIndexing(self):
+    "Stops a running indexer after its current batch, and waits for it."
+    if self.indexer_ is not None:
+      self.indexer_.cancelled = True
+      self.workers_.waitForDone()
+
+  def indexDone(self, n):
+    self.indexer_ = None
+    if n:
+      self.targeter.invalidateWords()
+    if self.reindex_:
+      self.indexTexts()
+
   def addFiles(self):
     qf = QFileDialog(self, "Import Text From File(s)", directory=str(Settings.DATA_DIR / "texts"))
     qf.setNameFilters(["UTF-8 text files (*.txt)", "All files (*)"])
@@ -209,43 +309,134 @@ Good luck!""",
     qf.show()
 
   def setImpList(self, files):
+    """Imports `files`, one source per file. Splitting into lessons and hashing
+    is done in parallel in worker processes, which send the lessons back in
+    chunks through a bounded queue; this thread only inserts them, from a timer
+    (see `importChunks()`)."""
     self.sender().hide()
+    if self.import_ is not None:
+      return
+    files = list(map(str, files))
+    names = [path.basename(x) for x in files]
+    # Sources are created up front so they're added in a predictable order.
+    for name in names:
+      DB.getSource(name)
+    DB.commit()
+
+    self.import_button.setEnabled(False)
+    self.progress.setRange(0, len(files))
+    self.progress.setValue(0)
     self.progress.show()
-    for x in map(str, files):
-      self.progress.setValue(0)
-      fname = path.basename(x)
+
+    opts = (Settings.get("min_chars"), Settings.get("max_chars"), Settings.get("break_sentences"))
+    # Not fork: the GUI process has Qt's threads (and our workers') running.
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue(maxsize=16)
+    pool = ProcessPoolExecutor(mp_context=ctx, initializer=init_worker, initargs=(results,))
+    self.import_ = dict(
+      names=names,
+      results=results,
+      pool=pool,
+      futures=[pool.submit(mine_file, i, x, *opts) for i, x in enumerate(files)],
+      left=len(files),
+      pending=None,  # (tag, lessons) of a chunk not yet fully inserted
+    )
+    self.import_timer.start()
+
+  def importChunks(self, budget=0.05, batch=100):
+    """Inserts the lessons received so far, `batch` at a time, for up to
+    `budget` seconds."""
+    imp = self.import_
+    t0 = timer()
+    while timer() - t0 < budget:
+      if imp["pending"] is not None:
+        tag, chunk = imp["pending"]
+        imp["pending"] = (tag, chunk[batch:]) if len(chunk) > batch else None
+        fname = imp["names"][tag]
+        try:
+          self.addHashedTexts(fname, chunk[:batch], update=False)
+        except Exception:
+          log.exception(f"failed to add texts from file {fname}!")
+        continue
+
       try:
-        lm = LessonMiner(x)
-      except Exception:
-        log.error(f"failed to process file {fname}!")
+        tag, chunk = imp["results"].get_nowait()
+      except queue.Empty:
+        futures = imp["futures"]
+        if all(f.done() for f in futures) and any(isinstance(f.exception(), BrokenProcessPool) for f in futures):
+          log.error("import worker process died; giving up on the remaining files")
+          self.importDone()
+        return
+
+      if chunk is not None:
+        imp["pending"] = (tag, chunk)
         continue
-      lm.progress[int].emit(self.progress.setValue)
-      self.addTexts(fname, lm, update=False)
 
+      # The file is done; its worker is about to return.
+      fname = imp["names"][tag]
+      exc = imp["futures"][tag].exception()
+      if exc is not None:
+        log.error(f"failed to process file {fname}!", exc_info=exc)
+      imp["left"] -= 1
+      self.progress.setValue(self.progress.value() + 1)
+      if imp["left"] == 0:
+        self.importDone()
+        return
+
+  def importDone(self):
+    self.import_timer.stop()
+    self.import_["pool"].shutdown()
+    self.import_ = None
+    self.import_button.setEnabled(True)
     self.progress.hide()
+    self.progress.setRange(0, 100)
     self.update()
-    DB.commit()
+    if self.reindex_:
+      self.indexTexts()
 
   def addTexts(self, source, texts, lesson=None, update=True):
+    return self.addHashedTexts(source, ((text_id(x), x) for x in texts), lesson, update)
+
+  def addHashedTexts(self, source, texts, lesson=None, update=True, batch_size=500):
+    """Adds `texts`, an iterable of `(text_id, text)` consumed lazily, to
+    `source` in a single transaction, skipping texts that already exist.
+    Returns the ids of the texts that were actually added."""
+    t0 = timer()
     id = DB.getSource(source, lesson)
+    dis = 1 if lesson == 2 else None
     r = []
-    for x in texts:
-      h = hashlib.sha1()
-      h.update(x.encode("utf-8"))
-      txt_id = h.hexdigest()
-      dis = 1 if lesson == 2 else None
-      try:
-        DB.execute(
-          "insert into text (id,text,source,disabled) values (?,?,?,?)",
-          (txt_id, x, id, dis),
+    n_chars = 0
+    try:
+      for batch in batched(texts, batch_size):
+        rows = {}
+        for k, x in batch:
+          rows.setdefault(k, x)
+          n_chars += len(x)
+        existing = set(
+          i for (i,) in DB.execute("select id from text where id in (%s)" % ",".join("?" * len(rows)), list(rows))
         )
-        r.append(txt_id)
-      except Exception:
-        pass  # silently skip ...
+        new = [(k, x, id, dis) for k, x in rows.items() if k not in existing]
+        DB.executemany("insert or ignore into text (id,text,source,disabled) values (?,?,?,?)", new)
+        r.extend(v[0] for v in new)
+      DB.commit()
+      if r and dis is None:  # Reviews are added disabled.
+        self.textsChanged()
+    except Exception:
+      DB.rollback()
+      raise
+
+    secs = max(timer() - t0, 1e-9)
+    log.info(
+      "imported %d new texts into %s: %d chars in %.2fs (%.0f texts/s, %.0f kchars/s)",
+      len(r),
+      source,
+      n_chars,
+      secs,
+      len(r) / secs,
+      n_chars / secs / 1000.0,
+    )
     if update:
       self.update()
-    if lesson:
-      DB.commit()
     return r
 
   def newReview(self, review):
@@ -265,17 +456,14 @@ Good luck!""",
 
     if type != 1:
       # Not in order
-      v = DB.execute(
-        "select id,source,text from text where disabled is null order by random() limit %d" % Settings.get("num_rand")
-      ).fetchall()
-      if len(v) == 0:
-        v = None
-      elif type == 2:
-        v = min(v, key=self.diff_eval)
-      elif type == 3:
-        v = max(v, key=self.diff_eval)
-      else:
-        v = v[0]  # random, just pick the first
+      v = None
+      if type == 2 or type == 3:
+        v = self.difficulty.pick(Settings.get("num_rand"), hardest=type == 2)
+      elif type == 4:
+        v = self.targeter.pick(Settings.get("num_rand"))
+      if v is None and type != 2 and type != 3:
+        v = self.sampler.sample(1)
+        v = v[0] if v else None
     else:
       # Fetch in order
       lastid = (0,)
@@ -318,13 +506,14 @@ Good luck!""",
     self.refreshSources.emit()
 
   def removeDisabled(self):
-    DB.execute("delete from text where disabled is not null")
+    DB.execute("delete from text where disabled is not null")  # The enabled texts stay the same.
     self.removeUnused()
     self.update()
     DB.commit()
 
   def enableAll(self):
     DB.execute("update text set disabled = null where disabled is not null")
+    self.textsChanged()
     self.update()
 
   def disableSelected(self):
@@ -340,6 +529,7 @@ Good luck!""",
         where source = ? and regex_match(text) = 1""",
       [(x,) for x in cats],
     )
+    self.textsChanged()
     self.update()
 
   def getSelected(self):
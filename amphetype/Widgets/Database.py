@@ -1,10 +1,12 @@
 import locale
 import time
 
-from PyQt5.QtWidgets import QApplication, QLabel, QProgressBar, QWidget
+from PyQt5.QtCore import QThreadPool, QTimer
+from PyQt5.QtWidgets import QApplication, QLabel, QMessageBox, QProgressBar, QWidget
 
-from amphetype.Config import Settings, SettingsEdit
+from amphetype.Config import Settings, SettingsCombo, SettingsEdit
 from amphetype.Data import DB
+from amphetype.maintenance import INCREMENTAL, Maintenance
 from amphetype.QtUtil import AmphBoxLayout, AmphButton
 
 locale.setlocale(locale.LC_ALL, "")
@@ -34,6 +36,12 @@ class DatabaseWidget(QWidget):
 
     self.stats_ = QLabel("\nPress Update to fetch database statistics\n")
     self.progress_ = IncrementalProgress(6 + 2)
+    self.go_ = AmphButton("Go!", lambda: self.cleanup())
+    self.maint_ = None
+    self.pool_ = QThreadPool(self, maxThreadCount=1)
+    self.timer_ = QTimer(self, timeout=self.scheduled, interval=15 * 60 * 1000)
+    self.timer_.start()
+    QTimer.singleShot(60 * 1000, self.scheduled)
 
     self.setLayout(
       AmphBoxLayout(
@@ -57,6 +65,22 @@ class DatabaseWidget(QWidget):
           ],  # AmphButton("Import", self.importdb), "external DB file"]]],
           self.stats_,
           None,
+          [
+            "Connection profile:",
+            SettingsCombo(
+              "db_profile",
+              [("fast", "Fast (write-ahead log)"), ("safe", "Safe (rollback journal, full sync)")],
+            ),
+            "with a page cache of",
+            SettingsEdit("db_cache_mb"),
+            "MB,",
+            SettingsEdit("db_mmap_mb"),
+            "MB of memory-mapped I/O and",
+            SettingsEdit("query_cache_mb"),
+            "MB of cached query results. Takes effect after a restart; use 'Safe' for databases on network drives.",
+            None,
+          ],
+          None,
           [
             "DELETE all statistics and results from:",
             AmphButton("Last Minute", lambda: self.delete_last(60.0)),
@@ -68,7 +92,8 @@ class DatabaseWidget(QWidget):
           "After heavy use for several months the database can grow quite large since "
           + "lots of data are generated after every result and it's all stored indefinitely. "
           + "Here you can group old statistics into larger batches. This will speed up "
-          + "data retrieval for statistics. It is recommended you do it once a month or so if you use the program regularly.\n",
+          + "data retrieval for statistics. It is recommended you do it once a month or so if you use the program regularly, "
+          + "or let it run in the background on a schedule. It works in small steps, so you can keep typing meanwhile.\n",
           [
             "Group data older than",
             SettingsEdit("group_month"),
@@ -79,7 +104,13 @@ class DatabaseWidget(QWidget):
             "days into days.",
             None,
           ],
-          [AmphButton("Go!", self.cleanup), None],
+          [
+            self.go_,
+            None,
+            "Automatically run every",
+            SettingsEdit("maint_interval"),
+            "days (0 to disable).",
+          ],
           [self.progress_],
           None,
         ]
@@ -95,6 +126,7 @@ class DatabaseWidget(QWidget):
     ds = DB.execute("""delete from statistic where w > ?""", (threshold,)).rowcount
     dm = DB.execute("""delete from mistake where w > ?""", (threshold,)).rowcount
     dr = DB.execute("""delete from result where w > ?""", (threshold,)).rowcount
+    DB.rebuildSummary(threshold)
 
     self.stats_.setText(f"Deleted {ds} statistic entries, {dm} mistake entries, {dr} results")
 
@@ -128,43 +160,53 @@ Analysis data: %d (%d keys, %d trigrams, %d words)
     # DB.switchdb(nn)
     pass
 
-  def cleanup(self):
-    day = 24 * 60 * 60
-    now = time.time()
-    q = []
-
-    self.progress_.show()
-    for grp, lim in [
-      (30.0, Settings.get("group_month")),
-      (7.0, Settings.get("group_week")),
-      (1.0, Settings.get("group_day")),
-    ]:
-      w = now - day * lim
-      g = grp * day
-      q.extend(
-        DB.fetchall(
-          """
-        select avg(w),data,type,agg_mean(time,count),sum(count),sum(mistakes),agg_median(viscosity)
-        from statistic where w <= %f
-        group by data,type,cast(w/%f as int)"""
-          % (w, g)
+  def cleanup(self, convert=True):
+    "Compacts old statistics in the background (see `amphetype.maintenance`)."
+    if self.maint_ is not None:
+      return
+    if convert and DB.fetchone("pragma auto_vacuum", (0,))[0] != INCREMENTAL:
+      convert = (
+        QMessageBox.question(
+          self,
+          "Convert Database",
+          "This database can't give back free space a little at a time yet. Converting it rewrites the whole "
+          "file once, and no typing statistics can be saved until that's done, which can take a while for a "
+          "large database.\n\nConvert it now? Old statistics are compacted either way.",
         )
+        == QMessageBox.Yes
       )
-      self.progress_.inc()
+    DB.commit()  # The worker's connections must see everything we've written.
+    self.maint_ = Maintenance(
+      DB,
+      [
+        (30.0, Settings.get("group_month")),
+        (7.0, Settings.get("group_week")),
+        (1.0, Settings.get("group_day")),
+      ],
+      convert=convert,
+    )
+    self.maint_.signals.progress.connect(self.maintenanceProgress)
+    self.maint_.signals.done.connect(self.maintenanceDone)
+    self.go_.setEnabled(False)
+    self.progress_.show()
+    self.pool_.start(self.maint_)
 
-      DB.execute("""delete from statistic where w <= ?""", (w,))
-      self.progress_.inc()
+  def scheduled(self):
+    days = Settings.get("maint_interval")
+    if days > 0 and time.time() - Settings.get("maint_last") >= days * 86400.0:
+      # Converting to incremental auto-vacuum rewrites the whole file; leave that to a manual run.
+      self.cleanup(convert=False)
 
-    DB.executemany(
-      """insert into statistic (w,data,type,time,count,mistakes,viscosity)
-      VALUES (?,?,?,?,?,?,?)""",
-      q,
-    )
-    self.progress_.inc()
-    DB.commit()
-    DB.execute("vacuum")
-    self.progress_.inc()
+  def maintenanceProgress(self, step, steps):
+    self.progress_.setRange(0, steps)
+    self.progress_.setValue(step)
+
+  def maintenanceDone(self, msg):
+    self.maint_ = None
+    Settings.set("maint_last", time.time())
     self.progress_.hide()
+    self.go_.setEnabled(True)
+    self.stats_.setText(msg)
 
 
 if __name__ == "__main__":
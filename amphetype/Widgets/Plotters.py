@@ -1,10 +1,12 @@
 import math
 from random import random
 
-from PyQt5.QtCore import QRectF, Qt
-from PyQt5.QtGui import QBrush, QColor, QKeySequence, QPainter, QPen, QTransform
+import numpy as np
+from PyQt5.QtCore import QPointF, QRectF, Qt
+from PyQt5.QtGui import QBrush, QColor, QKeySequence, QPainter, QPen, QPolygonF, QTransform
 from PyQt5.QtWidgets import (
   QApplication,
+  QGraphicsItem,
   QGraphicsRectItem,
   QGraphicsScene,
   QGraphicsSimpleTextItem,
@@ -87,24 +89,162 @@ class SimpleText(QGraphicsSimpleTextItem):
       self.setBrush(brush)
 
 
+class Polyline(QGraphicsItem):
+  "A polyline drawn as a single scene item."
+
+  # Qt strokes a long polyline as one big self-intersecting outline, which gets
+  # very slow with thousands of points; short runs are stroked much faster.
+  CHUNK = 16
+
+  def __init__(self, pen, *args):
+    super().__init__(*args)
+    self.pen_ = pen
+    self.poly_ = QPolygonF()
+    self.rect_ = QRectF()
+
+  def setPolygon(self, poly):
+    self.prepareGeometryChange()
+    self.poly_ = poly
+    self.rect_ = poly.boundingRect()
+
+  def boundingRect(self):
+    return self.rect_
+
+  def paint(self, painter, option, widget=None):
+    painter.setPen(self.pen_)
+    for i in range(0, self.poly_.size() - 1, self.CHUNK):
+      painter.drawPolyline(self.poly_.mid(i, self.CHUNK + 1))
+
+
+def decimate(x, y, columns):
+  """Indices of the points of the polyline `(x, y)` that must be kept to draw it
+  `columns` pixels wide: the first, last, lowest and highest point falling in
+  each column (the "M4" reduction). `x` must be non-decreasing.
+
+  """
+  n = len(x)
+  span = x[-1] - x[0]
+  if n <= 4 * columns or span <= 0:
+    return np.arange(n)
+  col = np.minimum(((x - x[0]) * (columns / span)).astype(np.int64), columns - 1)
+  starts = np.flatnonzero(np.r_[True, col[1:] != col[:-1]])
+  ends = np.r_[starts[1:], n] - 1
+  # Sorted by (column, y), each column's run begins at its lowest point and
+  # ends at its highest.
+  order = np.lexsort((y, col))
+  return np.unique(np.concatenate([starts, ends, order[starts], order[ends]]))
+
+
 class Plot(QGraphicsScene):
-  def __init__(self, x, y, *args):
+  """Line plot of the points `(x[i], y[i])`, which can be extended with
+  `append()`, `dropFirst()` and `setLast()` followed by `redraw()`. With
+  `left_axis` the vertical axis is drawn at the left edge instead of at x=0.
+  A `band` of `(x, lo, hi)` arrays is shaded behind the series.
+
+  The series is drawn as a single item, decimated to `columns` (the width of
+  the view, see `Plotter`) when it has many more points than that.
+
+  """
+
+  def __init__(self, x, y, *args, left_axis=False, band=None, columns=2000):
     super(Plot, self).__init__(*args)
 
     # self.connect(self, SIGNAL("sceneRectChanged(QRectF)"), self.setSceneRect)
 
+    self.x, self.y = [], []
+    self.left_axis = left_axis
+    self.columns = max(1, int(columns))
+    self.curve = None
+    self.band = band
+    self.band_item = None
+    self.decorations = []
+
+    self.pen = QPen(Qt.blue)
+    self.pen.setCosmetic(True)
+    self.pen.setWidthF(2.0)
+    self.pen.setCapStyle(Qt.RoundCap)
+
     if len(x) < 2:
       return
 
+    self.append(x, y)
+    self.redraw()
+
+  def append(self, x, y):
+    self.x.extend(x)
+    self.y.extend(y)
+
+  def dropFirst(self, n):
+    del self.x[:n], self.y[:n]
+
+  def setLast(self, x, y):
+    self.x[-1], self.y[-1] = x, y
+
+  def setColumns(self, columns):
+    "Sets the resolution the series is decimated to, redrawing it if that matters."
+    columns = max(1, int(columns))
+    if columns == self.columns:
+      return
+    redraw = len(self.x) > 4 * min(columns, self.columns)
+    self.columns = columns
+    if redraw:
+      self.drawCurve()
+      self.drawBand()
+
+  def drawCurve(self):
+    x = np.asarray(self.x, dtype=np.float64)
+    y = np.asarray(self.y, dtype=np.float64)
+    if len(x) > 4 * self.columns and np.all(x[1:] >= x[:-1]):
+      keep = decimate(x, y, self.columns)
+      x, y = x[keep], y[keep]
+    if self.curve is None:
+      self.curve = Polyline(self.pen)
+      self.addItem(self.curve)
+    self.curve.setPolygon(QPolygonF([QPointF(a, -b) for a, b in zip(x.tolist(), y.tolist(), strict=True)]))
+
+  def drawBand(self):
+    if self.band is None or len(self.band[0]) < 2:
+      return
+    x, lo, hi = (np.asarray(v, dtype=np.float64) for v in self.band)
+    if len(x) > 2 * self.columns and x[-1] > x[0] and np.all(x[1:] >= x[:-1]):
+      # A filled area only needs its outline per pixel column.
+      col = np.minimum(((x - x[0]) * (self.columns / (x[-1] - x[0]))).astype(np.int64), self.columns - 1)
+      starts = np.flatnonzero(np.r_[True, col[1:] != col[:-1]])
+      x, lo, hi = x[starts], np.minimum.reduceat(lo, starts), np.maximum.reduceat(hi, starts)
+    poly = QPolygonF(
+      [QPointF(a, -b) for a, b in zip(x.tolist(), hi.tolist(), strict=True)]
+      + [QPointF(a, -b) for a, b in zip(x[::-1].tolist(), lo[::-1].tolist(), strict=True)]
+    )
+    if self.band_item is None:
+      self.band_item = self.addPolygon(poly, QPen(Qt.NoPen), QBrush(QColor(0, 0, 255, 48)))
+      self.band_item.setZValue(-0.5)
+    else:
+      self.band_item.setPolygon(poly)
+
+  def addDecoration(self, item):
+    self.decorations.append(item)
+    return item
+
+  def redraw(self):
+    "(Re)draws the series, axes and background lines for the current points."
+    for item in self.decorations:
+      self.removeItem(item)
+    self.decorations = []
+
+    x, y = self.x, self.y
+    if len(x) < 2:
+      if self.curve is not None:
+        self.removeItem(self.curve)
+        self.curve = None
+      return
+    self.drawCurve()
+    self.drawBand()
+
     min_x, max_x = min(x), max(x)
     min_y, max_y = min(y), max(y)
-
-    p = QPen(Qt.blue)
-    p.setCosmetic(True)
-    p.setWidthF(2.0)
-    p.setCapStyle(Qt.RoundCap)
-    for i in range(0, len(x) - 1):
-      self.addLine(x[i], -y[i], x[i + 1], -y[i + 1], p)
+    if self.band is not None and len(self.band[0]) > 0:
+      min_x, max_x = min(min_x, np.min(self.band[0])), max(max_x, np.max(self.band[0]))
+      min_y, max_y = min(min_y, np.min(self.band[1])), max(max_y, np.max(self.band[2]))
 
     # Add axes
     if Settings.get("show_xaxis"):
@@ -112,11 +252,13 @@ class Plot(QGraphicsScene):
         min_y = 0
       elif max_y < 0:
         max_y = 0
+    p = QPen(self.pen)
     p.setColor(Qt.black)
     if min_y <= 0 <= min_y:
-      self.addLine(min_x, 0, max_x, 0, p)
-    if min_x <= 0 <= max_x:
-      self.addLine(0, -min_y, 0, -max_y, p)
+      self.addDecoration(self.addLine(min_x, 0, max_x, 0, p))
+    ax = min_x if self.left_axis else 0
+    if min_x <= ax <= max_x:
+      self.addDecoration(self.addLine(ax, -min_y, ax, -max_y, p))
 
     w, h = max_x - min_x, max_y - min_y
 
@@ -137,7 +279,7 @@ class Plot(QGraphicsScene):
     qp.setCosmetic(True)
 
     while start < max_y + spc:
-      lin = self.addLine(min_x, -start, max_x, -start, qp)
+      lin = self.addDecoration(self.addLine(min_x, -start, max_x, -start, qp))
       lin.setZValue(-1.0)
 
       txt = QGraphicsSimpleTextItem("%g" % start)
@@ -145,7 +287,7 @@ class Plot(QGraphicsScene):
 
       txt.setTransform(QTransform().translate(min_x - 0.03 * w, -start - spc / 2).scale(0.026 * w / tw, spc / th))
 
-      self.addItem(txt)
+      self.addItem(self.addDecoration(txt))
       start += spc
 
     qr = QRectF(min_x - 0.03 * w, -start + spc / 2, 1.06 * float(w), start - ns)
@@ -163,10 +305,16 @@ class Plotter(QGraphicsView):
     QGraphicsView.resizeEvent(self, evt)
     if self.scene():
       self.fitInView(self.scene().sceneRect())
+      self.updateColumns()
 
   def setScene(self, scene):
     QGraphicsView.setScene(self, scene)
     self.fitInView(scene.sceneRect())
+    self.updateColumns()
+
+  def updateColumns(self):
+    if isinstance(self.scene(), Plot):
+      self.scene().setColumns(self.viewport().width())
 
 
 if __name__ == "__main__":
@@ -38,6 +38,8 @@ AMPH_LOGFILE   specifies a file to log info/errors/warning to. If set to "-",
                stdout will be used instead. Equivalent to the "-L" argument.
 AMPH_SETTINGS  specifies the settings file. Equivalent to "-s" argument.
 AMPH_LOCAL     setting this to "1" is the same as specifying "-l".
+AMPH_LATENCY   setting this to "1" is the same as specifying "-P".
+AMPH_DB_PROFILE  the database connection profile. Equivalent to "--db-profile".
 """)
   p.add_argument('-l', '--local', action='store_true',
                  help=f"""uses the local data directory ({DATA_DIR}) for database and
@@ -47,8 +49,15 @@ AMPH_LOCAL     setting this to "1" is the same as specifying "-l".
                  help='uses the database file %(metavar)s')
   p.add_argument('-s', '--settings', metavar='INIFILE',
                  help="uses settings file %(metavar)s")
+  p.add_argument('--db-profile', choices=['fast', 'safe'],
+                 help="""overrides the database connection profile from the settings:
+                 "fast" uses write-ahead logging and relaxed syncing, "safe" the
+                 SQLite defaults (e.g. for databases on network drives).""")
   p.add_argument('-L', '--log', metavar='LOGFILE',
                  help="""enables logging to the given file; use "-" to log to stdout""")
+  p.add_argument('-P', '--latency', action='store_true',
+                 help="""measures how long keystroke handling takes and shows the
+                 median and 99th percentile in an overlay on the typer.""")
   p.add_argument('-V', '--version', action='version', version=f'amphetype {__version__}')
 
   # parse_known_args() because there might be QT arguments?
@@ -56,6 +65,8 @@ AMPH_LOCAL     setting this to "1" is the same as specifying "-l".
 
   args.settings = args.settings or os.environ.get('AMPH_SETTINGS')
   args.local = args.local or _env_true(os.environ.get('AMPH_LOCAL'))
+  args.latency = args.latency or _env_true(os.environ.get('AMPH_LATENCY'))
+  args.db_profile = args.db_profile or os.environ.get('AMPH_DB_PROFILE')
 
   logfile = args.log or os.environ.get('AMPH_LOGFILE')
   logargs = dict(level=logging.DEBUG)
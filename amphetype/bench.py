@@ -0,0 +1,270 @@
+"""Headless keystroke-replay benchmark for the typing engines.
+
+Replays synthetic (or recorded) keystroke streams through Typer 1
+(`Quizzer.Typer`) and Typer 2 (`LessonDocument`) and through the
+post-lesson processing (`Quizzer.done()`, `TyperWindow.typingDone()`) against a
+throw-away database, and reports what each stage costs:
+
+  python -m amphetype.bench [--sizes 250,1000,5000] [--engine 1|2|both]
+
+A recorded stream is a JSON list of `[timestamp, key]` pairs where `key` is a
+single character, `"\\b"` for backspace or `"\\n"` for return. Timestamps drive
+the engines' clock, so the statistics they compute are reproducible; the costs
+reported are real wall times.
+
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+from amphetype import DATA_DIR, cli_options, timer
+
+
+def synthetic_stream(text, seed=0, error_rate=0.03, wpm=70.0):
+  """Keystrokes for typing `text`, with occasional wrong keys that are then
+  backspaced over. Returns `[(timestamp, key)]`."""
+  rng = random.Random(seed)
+  mean = 12.0 / wpm
+  t = 0.0
+  res = []
+  for c in text:
+    if rng.random() < error_rate:
+      t += rng.expovariate(1.0 / mean)
+      res.append((t, rng.choice("abcdefghijklmnopqrstuvwxyz")))
+      t += rng.expovariate(1.0 / mean)
+      res.append((t, "\b"))
+    t += rng.expovariate(1.0 / mean)
+    res.append((t, c))
+  return res
+
+
+def sample_text(size, seed=0):
+  "A `size`-character excerpt of one of the bundled texts, broken into lines."
+  files = sorted((DATA_DIR / "texts").glob("*.txt"))
+  words = []
+  for f in files:
+    words.extend(f.read_text(encoding="utf-8-sig").split())
+    if sum(map(len, words)) > 4 * size:
+      break
+  start = random.Random(seed).randrange(max(1, len(words) - size))
+  text = " ".join(words[start : start + size])[:size].strip()
+  # A few line breaks so the return key is exercised.
+  return "\n".join(text[i : i + 400].strip() for i in range(0, len(text), 400))[:size]
+
+
+class FakeClock:
+  def __init__(self, start=1000.0):
+    self.now = start
+
+  def __call__(self):
+    return self.now
+
+
+def stats(xs):
+  "`(mean, p50, p99)` of `xs` in microseconds."
+  xs = sorted(xs)
+  if not xs:
+    return (0.0, 0.0, 0.0)
+  return (
+    1e6 * sum(xs) / len(xs),
+    1e6 * xs[len(xs) // 2],
+    1e6 * xs[min(len(xs) - 1, int(0.99 * len(xs)))],
+  )
+
+
+def add_text(db, text):
+  import hashlib
+
+  src = db.getSource("<Benchmark>")
+  tid = hashlib.sha1(text.encode("utf-8")).hexdigest()
+  db.execute("insert or ignore into text (id,source,text) values (?,?,?)", (tid, src, text))
+  db.commit()
+  return (tid, src, text)
+
+
+def bench_typer1(app, db, text, stream):
+  from PyQt5.QtCore import Qt
+  from PyQt5.QtTest import QTest
+
+  import amphetype.Quizzer as Q
+
+  clock = FakeClock()
+  Q.timer = clock
+
+  quiz = Q.Quizzer()
+  quiz.setText(add_text(db, text))
+
+  done_cost, run = [], []
+  quiz.typer.sigDone.disconnect(quiz.done)
+
+  def _done():
+    run.append(quiz.typer.getStats())  # done() may reset the typer.
+    t = timer()
+    quiz.done()
+    done_cost.append(timer() - t)
+
+  quiz.typer.sigDone.connect(_done)
+
+  clock.now = stream[0][0] - 1.0
+  QTest.keyClick(quiz.typer, " ")  # Wait for <SPACE> before start.
+
+  keys = []
+  for ts, k in stream:
+    clock.now = ts
+    t = timer()
+    if k == "\b":
+      QTest.keyClick(quiz.typer, Qt.Key_Backspace)
+    elif k == "\n":
+      QTest.keyClick(quiz.typer, Qt.Key_Return)
+    else:
+      QTest.keyClicks(quiz.typer, k)
+    keys.append(timer() - t)
+    if done_cost:
+      break
+  app.processEvents()
+
+  res = dict(keys=keys, done=done_cost, extract=[], write=[])
+  if run:
+    elapsed, chars, times, mis, mistakes = run[0]
+    t = timer()
+    vals = Q.run_statistics(text, times, mis, elapsed / chars, clock.now)
+    res["extract"].append(timer() - t)
+    t = timer()
+    db.addStatistics(vals)
+    db.executemany_(
+      "insert into mistake (w,target,mistake,count) values (?,?,?,?)",
+      [(clock.now, k[0], k[1], v) for k, v in mistakes.items()],
+    )
+    db.commit()
+    res["write"].append(timer() - t)
+  return res
+
+
+def bench_typer2(app, db, text, stream):
+  import amphetype.timingtuple as TT
+  import amphetype.typer as T
+
+  clock = FakeClock()
+  TT.timer = clock
+  T.timer = clock
+
+  tw = T.TyperWindow()
+  lesson = add_text(db, text)
+  tw.setText(lesson)
+  doc = tw._doc
+
+  runs, done_cost = [], []
+  doc.completed.disconnect(tw.typingDone)
+
+  def _done(run):
+    runs.append(run)
+    t = timer()
+    tw.typingDone(run)
+    done_cost.append(timer() - t)
+
+  doc.completed.connect(_done)
+
+  clock.now = stream[0][0] - 1.0
+  doc.start()
+
+  keys = []
+  for ts, k in stream:
+    clock.now = ts
+    t = timer()
+    if k == "\b":
+      doc.backspace()
+    elif k == "\n":
+      doc.insert(T.RETURN_CHAR)
+    else:
+      doc.insert(k)
+    keys.append(timer() - t)
+    if runs:
+      break
+
+  # Let the background writer finish before measuring its parts in isolation.
+  tw._writer.waitForDone()
+  app.processEvents()
+
+  res = dict(keys=keys, done=done_cost, extract=[], write=[])
+  if runs:
+    t = timer()
+    vals, mistakes = T.run_statistics(runs[0], clock.now)
+    res["extract"].append(timer() - t)
+    t = timer()
+    T.StatsWriter(db, runs[0], clock.now).store(vals, mistakes)
+    res["write"].append(timer() - t)
+  return res
+
+
+def main(argv=None):
+  p = argparse.ArgumentParser(prog="python -m amphetype.bench", description=__doc__.split("\n\n")[0])
+  p.add_argument("--sizes", default="250,1000,5000", help="comma-separated text sizes in characters")
+  p.add_argument("--engine", choices=["1", "2", "both"], default="both")
+  p.add_argument("--error-rate", type=float, default=0.03)
+  p.add_argument("--seed", type=int, default=0)
+  p.add_argument("--replay", metavar="FILE", help="JSON keystroke stream to replay (text is what it types)")
+  args = p.parse_args(argv)
+
+  os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+  with tempfile.TemporaryDirectory(prefix="amphbench") as tmp:
+    run_benchmarks(args, tmp)
+
+
+def run_benchmarks(args, tmp):
+  # Settings and database are only looked up when first imported below.
+  cli_options.database = str(Path(tmp) / "bench.db")
+  cli_options.settings = str(Path(tmp) / "bench.ini")
+
+  from PyQt5.QtWidgets import QApplication
+
+  app = QApplication.instance() or QApplication([sys.argv[0]])
+
+  from amphetype.Config import Settings
+  from amphetype.Data import DB
+
+  app.settings = Settings
+  app.DB = DB
+
+  if args.replay:
+    with open(args.replay) as f:
+      stream = [(float(t), k) for t, k in json.load(f)]
+    # Reconstruct the typed text by applying backspaces.
+    typed = []
+    for _, k in stream:
+      if k == "\b":
+        if typed:
+          typed.pop()
+      else:
+        typed.append(k)
+    cases = [("".join(typed), stream)]
+  else:
+    cases = []
+    for n in map(int, args.sizes.split(",")):
+      text = sample_text(n, args.seed)
+      cases.append((text, synthetic_stream(text, args.seed, args.error_rate)))
+
+  engines = ["1", "2"] if args.engine == "both" else [args.engine]
+  print(
+    f"{'engine':8s} {'chars':>6s} {'keys':>6s}   {'key mean/p50/p99 (us)':>24s} {'done (ms)':>10s} {'extract (ms)':>13s} {'write (ms)':>11s}"
+  )
+  for text, stream in cases:
+    for e in engines:
+      res = (bench_typer1 if e == "1" else bench_typer2)(app, DB, text, stream)
+      mean, p50, p99 = stats(res["keys"])
+      ms = lambda k, res=res: f"{1e3 * sum(res[k]):.2f}" if res.get(k) else "-"  # noqa: E731
+      print(
+        f"{'Typer ' + e:8s} {len(text):6d} {len(res['keys']):6d}   {mean:8.1f}/{p50:7.1f}/{p99:7.1f}"
+        f" {ms('done'):>10s} {ms('extract'):>13s} {ms('write'):>11s}"
+      )
+  if DB.pool_ is not None:
+    DB.pool_.close()
+  DB.close()
+
+
+if __name__ == "__main__":
+  main()
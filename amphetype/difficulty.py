@@ -0,0 +1,307 @@
+"""Statistics-driven text selection: the "Difficult", "Easy" and "Targeted" methods.
+
+A text's difficulty is the WPM you would be expected to type it at, going by
+the median time of each of its trigrams in your recent statistics (trigrams
+you have no data for count as a slowish 75th percentile time).
+
+Scoring every text the naive way means walking each text in Python once per
+lesson. Instead `DifficultyEstimator` encodes the library once into a flat
+array of trigram ids, so that re-scoring everything after new statistics is a
+single gather-and-sum over that array.
+
+`WeaknessTargeter` instead looks for the texts densest in your most damaging
+keys, trigrams and words, counting them in the same encoding (and words in the
+`text_word` index).
+
+"""
+
+import logging as log
+import random
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from amphetype import timer
+from amphetype.Data import DB
+
+_BITS = 21  # Enough for any Unicode code point.
+_MASK = (1 << _BITS) - 1
+
+
+def trigram_keys(text):
+  "Every trigram of `text` packed into one uint64 (three 21-bit code points)."
+  c = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+  if len(c) < 3:
+    return np.empty(0, dtype=np.uint64)
+  return (c[:-2] << np.uint64(2 * _BITS)) | (c[1:-1] << np.uint64(_BITS)) | c[2:]
+
+
+def key_trigram(k):
+  k = int(k)
+  return chr(k >> 2 * _BITS) + chr((k >> _BITS) & _MASK) + chr(k & _MASK)
+
+
+class DifficultyEstimator:
+  """Cached difficulty scores for all enabled texts.
+
+  The trigram encoding depends only on the text table and is dropped by
+  `invalidateTexts()`; the scores also depend on the statistics and are dropped
+  by `invalidateScores()`. Both are rebuilt lazily on the next `pick()`.
+
+  """
+
+  def __init__(self, chunk_size=2000):
+    self.chunk_size = chunk_size
+    self.history = 30.0
+    self.invalidateTexts()
+
+  def invalidateTexts(self):
+    self.rowids = None  # rowid of each encoded text
+    self.ids = None  # trigram id of each trigram position, all texts concatenated
+    self.counts = None  # number of trigrams in each text
+    self.starts = None  # index into `ids` of the first trigram of each text
+    self.vocab = None  # packed trigram of each id
+    self.scores = None
+
+  def invalidateScores(self):
+    self.scores = None
+
+  def setHistory(self, days):
+    self.history = days
+    self.invalidateScores()
+
+  def encode(self):
+    t0 = timer()
+    vocab = {}
+    rowids, ids, counts = [], [], []
+    cur = DB.execute("select rowid,text from text where disabled is null order by rowid")
+    while rows := cur.fetchmany(self.chunk_size):
+      keys = [trigram_keys(text) for _, text in rows]
+      lens = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+      uniq, inv = np.unique(np.concatenate(keys), return_inverse=True)
+      gid = np.fromiter((vocab.setdefault(int(k), len(vocab)) for k in uniq), dtype=np.uint32, count=len(uniq))
+      # This array is as long as the library, so keep it as narrow as the vocabulary allows.
+      ids.append(gid[inv].astype(np.uint16 if len(vocab) <= 1 << 16 else np.uint32))
+      counts.append(lens)
+      rowids.extend(r for r, _ in rows)
+
+    self.rowids = np.array(rowids, dtype=np.int64)
+    self.ids = np.concatenate(ids) if ids else np.empty(0, dtype=np.uint16)
+    self.counts = np.concatenate(counts) if counts else np.empty(0, dtype=np.int64)
+    self.starts = np.cumsum(self.counts) - self.counts
+    self.vocab = np.fromiter(vocab, dtype=np.uint64, count=len(vocab))
+    log.debug(
+      f"encoded {len(self.rowids)} texts ({len(self.ids)} trigrams, {len(vocab)} distinct) in {timer() - t0:.3f}s"
+    )
+
+  def trigramTimes(self):
+    hist = int((time.time() - 86400.0 * self.history) // 86400)
+    return {
+      t: v
+      for t, v in DB.execute(
+        """
+          select data,agg_wmedian(time_sum/count,count) from statistic_day
+          where day >= ? and type = 1
+          group by data""",
+        (hist,),
+      )
+      if v is not None
+    }
+
+  def score(self):
+    if self.rowids is None:
+      self.encode()
+    t0 = timer()
+    tri = self.trigramTimes()
+    if not tri:
+      # No statistics: every text is as good as any other.
+      self.scores = np.ones(len(self.rowids))
+      return
+    g = sorted(tri.values(), reverse=True)
+    expect = g[len(g) // 4]
+
+    times = np.fromiter((tri.get(key_trigram(k), expect) for k in self.vocab), dtype=np.float64, count=len(self.vocab))
+    # Each text's trigrams are contiguous in `ids`; texts without any (where
+    # reduceat() would not give 0) are left out.
+    nz = self.counts > 0
+    sums = np.zeros(len(self.rowids))
+    if nz.any():
+      sums[nz] = np.add.reduceat(times[self.ids], self.starts[nz])
+    with np.errstate(divide="ignore", invalid="ignore"):
+      self.scores = 12.0 * self.counts / sums  # WPM; NaN for texts too short to have a trigram.
+    log.debug(f"scored {len(self.rowids)} texts in {timer() - t0:.3f}s")
+
+  def pick(self, k, hardest=True):
+    """Returns a random `(id, source, text)` among the `k` hardest (or easiest)
+    enabled texts, or `None` if there are none."""
+    if self.scores is None:
+      self.score()
+    valid = np.flatnonzero(~np.isnan(self.scores))
+    if len(valid) == 0:
+      return None
+    s = self.scores[valid] if hardest else -self.scores[valid]
+    k = max(1, min(k, len(valid)))
+    best = valid[np.argpartition(s, k - 1)[:k]] if k < len(valid) else valid
+    row = DB.fetchone(
+      "select id,source,text from text where rowid = ? and disabled is null",
+      None,
+      (int(self.rowids[random.choice(best)]),),
+    )
+    if row is None:
+      self.invalidateTexts()  # Table changed behind our back.
+    return row
+
+
+class WeaknessTargeter:
+  """Ranks enabled texts by how densely they contain your most damaging keys,
+  trigrams and words, damage being `count * time^2 * (1 + mistakes/count)` as
+  in the Analysis tab.
+
+  Finding the weaknesses means aggregating the whole history, so it's left to
+  the owner: run `weaknessQuery()` on a worker and hand the rows to
+  `setWeaknesses()` (see `TextManager.refreshWeaknesses()`). Until then
+  `pick()` returns `None`.
+
+  Texts are scored against the trigram encoding of `estimator`, from which a
+  posting list is built: the text of every trigram position, ordered by packed
+  trigram so that each trigram, and all the trigrams starting with a key, are
+  one run. The occurrences of each weak item in each text are counted once from
+  its run and cached, so when the weaknesses change only the new items are
+  counted.
+
+  """
+
+  def __init__(self, estimator, per_type=20, candidates=500):
+    self.estimator = estimator
+    self.per_type = per_type
+    self.candidates = candidates
+    self.history = 30.0
+    self.weakness = None  # {(type, data): weight}, weights of each type summing to 1
+    self.vectors = {}  # (type, data) -> occurrences in each text of the encoding
+    self.encoded = None  # the `estimator.ids` the postings and vectors are of
+    self.keys = None  # the distinct packed trigrams, sorted
+    self.bounds = None  # where the run of each of `keys` starts in `postings`
+    self.postings = None  # text (index into the encoding) of each trigram position
+    self.ranked = None  # rowids of the best texts, best first
+
+  def invalidateTexts(self):
+    self.ranked = None
+    if self.estimator.rowids is None:
+      self.encoded = self.keys = self.bounds = self.postings = None  # Rebuilt with the encoding.
+
+  def invalidateWords(self):
+    "Must be called when the word index has changed."
+    self.vectors = {x: v for x, v in self.vectors.items() if x[0] != 2}
+    self.ranked = None
+
+  def setHistory(self, days):
+    self.history = days
+
+  def weaknessQuery(self):
+    "The `(tables, sql, args)` of the query whose rows `setWeaknesses()` takes."
+    hist = int((time.time() - 86400.0 * self.history) // 86400)
+    sql = """select type,data,damage from
+        (select type,data,damage,row_number() over (partition by type order by damage desc) as rank
+        from
+          (select type,data,total*time*time*(1.0+misses/total) as damage
+          from
+            (select type,data,agg_wmedian(time_sum/count,count) as time,
+            sum(count) as total,sum(mistakes) as misses
+            from statistic_day where day >= ? and type in (0,1,2) group by type,data)))
+      where rank <= ? and damage > 0"""
+    return ["statistic_day"], sql, (hist, self.per_type)
+
+  def setWeaknesses(self, rows):
+    "Takes the `(type, data, damage)` rows of `weaknessQuery()`."
+    totals = defaultdict(float)
+    for tp, _, d in rows:
+      totals[tp] += d
+    weakness = {(tp, g): d / totals[tp] for tp, g, d in rows}
+    if weakness != self.weakness:
+      self.weakness = weakness
+      self.ranked = None
+
+  def index(self):
+    t0 = timer()
+    est = self.estimator
+    n = len(est.rowids)
+    order = np.argsort(est.vocab)
+    rank = np.empty(len(order), dtype=est.ids.dtype)
+    rank[order] = np.arange(len(order))
+    r = rank[est.ids]
+    owner = np.repeat(np.arange(n, dtype=np.uint16 if n <= 1 << 16 else np.uint32), est.counts)
+    self.postings = owner[np.argsort(r, kind="stable")]
+    self.bounds = np.concatenate(([0], np.cumsum(np.bincount(r, minlength=len(order)))))
+    self.keys = est.vocab[order]
+    log.debug(f"indexed {len(self.postings)} trigram positions in {timer() - t0:.3f}s")
+
+  def count(self, items):
+    "Counts the occurrences of `(type, data)` items in each encoded text."
+    est = self.estimator
+    n = len(est.rowids)
+    for tp, g in items:
+      if tp == 2:
+        v = np.zeros(n, dtype=np.float32)
+        rows = np.array(DB.wordTexts(g), dtype=np.int64).reshape(-1, 2)
+        i = np.minimum(np.searchsorted(est.rowids, rows[:, 0]), n - 1)
+        ok = est.rowids[i] == rows[:, 0]  # Not texts added since the encoding.
+        np.add.at(v, i[ok], rows[ok, 1])
+      else:
+        if tp == 1:
+          k = trigram_keys(g)
+          lo, hi = np.searchsorted(self.keys, [k[0], k[0] + np.uint64(1)]) if len(k) == 1 else (0, 0)
+        else:
+          # Keys are counted through the trigrams they start.
+          c = np.uint64(ord(g[0]))
+          lo, hi = np.searchsorted(self.keys, [c << np.uint64(2 * _BITS), (c + np.uint64(1)) << np.uint64(2 * _BITS)])
+        run = self.postings[self.bounds[lo] : self.bounds[hi]]
+        v = np.bincount(run, minlength=n).astype(np.float32)
+      self.vectors[tp, g] = v
+
+  def rank(self):
+    t0 = timer()
+    est = self.estimator
+    if est.rowids is None:
+      est.encode()
+    if len(est.rowids) == 0:
+      self.ranked = est.rowids
+      return
+    if self.encoded is not est.ids:
+      self.index()
+      self.vectors = {}
+      self.encoded = est.ids
+    elif len(self.vectors) > 4 * len(self.weakness):
+      self.vectors = {x: v for x, v in self.vectors.items() if x in self.weakness}
+    new = [x for x in self.weakness if x not in self.vectors]
+    self.count(new)
+
+    score = np.zeros(len(est.rowids))
+    for x, w in self.weakness.items():
+      score += w * self.vectors[x]
+    score /= est.counts + 2  # Per character.
+    k = min(self.candidates, len(score))
+    best = np.argpartition(-score, k - 1)[:k] if k < len(score) else np.arange(k)
+    best = best[np.argsort(-score[best], kind="stable")]
+    self.ranked = est.rowids[best[score[best] > 0]]
+    log.debug(f"ranked {len(self.ranked)} targeted texts ({len(new)} new items) in {timer() - t0:.3f}s")
+
+  def pick(self, k):
+    """Returns a random `(id, source, text)` among the `k` texts best matching
+    your weaknesses, or `None` if there are none (e.g. no statistics yet)."""
+    if not self.weakness:
+      return None
+    if self.ranked is None:
+      self.rank()
+    if len(self.ranked) == 0:
+      return None
+    row = DB.fetchone(
+      "select id,source,text from text where rowid = ? and disabled is null",
+      None,
+      (int(random.choice(self.ranked[: max(1, k)])),),
+    )
+    if row is None:
+      # Table changed behind our back.
+      self.estimator.invalidateTexts()
+      self.invalidateTexts()
+    return row
@@ -0,0 +1,119 @@
+"""Keystroke latency instrumentation, enabled with `--latency`.
+
+Handlers decorated with `timed()` record their wall time into per-name ring
+buffers. When instrumentation is off the decorator returns the function
+untouched, so there is no overhead at all.
+
+"""
+
+import functools
+from array import array
+
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import QLabel
+
+from amphetype import cli_options, timer
+
+
+class RingBuffer:
+  def __init__(self, size=2048):
+    self._data = array("d", [0.0]) * size
+    self._count = 0
+
+  def append(self, x):
+    self._data[self._count % len(self._data)] = x
+    self._count += 1
+
+  def __len__(self):
+    return min(self._count, len(self._data))
+
+  def values(self):
+    return self._data[: len(self)]
+
+  def percentiles(self, *ps):
+    xs = sorted(self.values())
+    if not xs:
+      return tuple(None for _ in ps)
+    return tuple(xs[min(len(xs) - 1, int(p * len(xs)))] for p in ps)
+
+
+class LatencyRecorder:
+  def __init__(self, size=2048):
+    self._size = size
+    self._buffers = {}
+
+  def record(self, name, secs):
+    buf = self._buffers.get(name)
+    if buf is None:
+      buf = self._buffers[name] = RingBuffer(self._size)
+    buf.append(secs)
+
+  def names(self):
+    return list(self._buffers)
+
+  def summary(self):
+    """Returns `[(name, count, p50, p99)]` with times in milliseconds."""
+    res = []
+    for name, buf in self._buffers.items():
+      p50, p99 = buf.percentiles(0.5, 0.99)
+      res.append((name, len(buf), 1000.0 * p50, 1000.0 * p99))
+    return res
+
+
+# GLOBAL; None unless enabled on the command line.
+recorder = LatencyRecorder() if cli_options.latency else None
+
+
+def timed(name):
+  """Decorator that records the latency of every call under `name`."""
+
+  def _decorator(func):
+    if recorder is None:
+      return func
+
+    @functools.wraps(func)
+    def _timed(*args, **kwargs):
+      t = timer()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        recorder.record(name, timer() - t)
+
+    return _timed
+
+  return _decorator
+
+
+class LatencyOverlay(QLabel):
+  """Small translucent label in the top right corner of `parent` showing the
+  recorded latencies. Does nothing if instrumentation is off."""
+
+  def __init__(self, parent, interval=500):
+    super().__init__(parent)
+    self.setAttribute(Qt.WA_TransparentForMouseEvents)
+    self.setStyleSheet("QLabel { background-color: rgba(0, 0, 0, 160); color: white; padding: 4px; }")
+    self.setTextFormat(Qt.RichText)
+    self.hide()
+    if recorder is None:
+      return
+
+    self._timer = QTimer(self, timeout=self.refresh)
+    self._timer.start(interval)
+
+  def refresh(self):
+    rows = recorder.summary()
+    if not rows:
+      return
+    self.setText(
+      "<table>"
+      + "<tr><th align=left>handler</th><th>n</th><th>p50</th><th>p99</th></tr>"
+      + "".join(
+        f"<tr><td>{name}</td><td align=right>{n}</td><td align=right>{p50:.2f}ms</td><td align=right>{p99:.2f}ms</td></tr>"
+        for name, n, p50, p99 in rows
+      )
+      + "</table>"
+    )
+    self.adjustSize()
+    self.move(self.parentWidget().width() - self.width() - 4, 4)
+    self.show()
+    self.raise_()
@@ -0,0 +1,196 @@
+"""Background database maintenance.
+
+Old statistics are compacted by grouping them into months, weeks and days
+(as configured on the Database tab). This is done one bounded chunk of time
+at a time, each chunk in its own short transaction, so the typers can keep
+writing in between. Freed pages are then returned to the file system a few
+at a time with `PRAGMA incremental_vacuum` rather than by a full `VACUUM`.
+
+The word index of the texts (`text_word`) is filled in the same way by
+`TextIndexer`, a batch of texts per transaction.
+
+"""
+
+import logging as log
+import math
+import time
+
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+
+DAY = 86400.0
+
+# Auto-vacuum mode that lets incremental_vacuum reclaim pages.
+INCREMENTAL = 2
+
+
+def compaction_plan(db, tiers, now, chunk_days=30.0):
+  """Chunks to compact, as `(lo, hi, start, end, group)` tuples: statistics with
+  `lo < w <= hi` and `start <= w < end` are grouped into buckets of `group`
+  seconds. `tiers` are `(group_days, older_than_days)` pairs, coarsest first;
+  each tier only covers the data the previous one left alone."""
+  chunks = []
+  prev = -math.inf
+  for grp, lim in tiers:
+    cut = now - DAY * lim
+    if cut <= prev:
+      continue
+    g = grp * DAY
+    first = db.fetchone("select min(w) from statistic where w > ? and w <= ?", (None,), (prev, cut))[0]
+    if first is not None:
+      step = g * max(1, int(chunk_days // grp))
+      start = math.floor(first / g) * g
+      while start <= cut:
+        chunks.append((prev, cut, start, start + step, g))
+        start += step
+    prev = cut
+  return chunks
+
+
+def compact_chunk(db, lo, hi, start, end, g):
+  """Groups the statistics of one chunk in a single transaction. Returns the
+  number of rows before and after."""
+  args = (lo, hi, start, end)
+  # A month of a common key can be tens of thousands of rows; past a couple of
+  # thousand a sampled median is as good and keeps the worker's memory bounded.
+  db.execute("begin immediate")
+  try:
+    before = db.fetchone("select count(*) from statistic where w > ? and w <= ? and w >= ? and w < ?", (0,), args)[0]
+    rows = db.fetchall(
+      """select avg(w),data,type,agg_mean(time,count),sum(count),sum(mistakes),
+        agg_approx_quantile(viscosity,0.5)
+      from statistic where w > ? and w <= ? and w >= ? and w < ?
+      group by data,type,cast(w/? as int)""",
+      args + (g,),
+    )
+    if len(rows) < before:
+      db.execute("delete from statistic where w > ? and w <= ? and w >= ? and w < ?", args)
+      db.executemany_(
+        """insert into statistic (w,data,type,time,count,mistakes,viscosity)
+        values (?,?,?,?,?,?,?)""",
+        rows,
+      )
+      db.rebuildSummary(max(lo, start), min(hi, end))
+    db.commit()
+  except Exception:
+    db.rollback()
+    raise
+  return before, len(rows)
+
+
+class MaintenanceSignals(QObject):
+  progress = pyqtSignal(int, int)
+  done = pyqtSignal(str)
+
+
+class Maintenance(QRunnable):
+  """Compacts old statistics and reclaims free pages in a worker thread,
+  through the database's `ConnectionPool`. The writer is taken one chunk at a
+  time, so the typers can save their statistics in between. Emits
+  `signals.progress` with `(step, steps)` and finally `signals.done` with a
+  summary (or the error).
+
+  A database that doesn't use incremental auto-vacuum yet is only converted if
+  `convert` is set. That needs one full `VACUUM`, which holds the writer (and
+  so keeps everyone else from writing) until it's done.
+
+  """
+
+  def __init__(self, db, tiers, convert=False, chunk_days=30.0, vacuum_pages=1024):
+    super().__init__()
+    self.signals = MaintenanceSignals()
+    self._db = db
+    self._tiers = tiers
+    self._convert = convert
+    self._chunk_days = chunk_days
+    self._vacuum_pages = vacuum_pages
+
+  def run(self):
+    t0 = time.time()
+    try:
+      msg = self.maintain(self._db.pool())
+    except Exception as e:
+      log.exception("database maintenance failed")
+      msg = f"Maintenance failed: {e}"
+    else:
+      log.info("database maintenance done in %.1fs: %s", time.time() - t0, msg)
+    self.signals.done.emit(msg)
+
+  def maintain(self, pool):
+    with pool.read() as db:
+      chunks = compaction_plan(db, self._tiers, time.time(), self._chunk_days)
+    steps = len(chunks) + 1
+    before = n_rows = 0
+    for i, chunk in enumerate(chunks):
+      self.signals.progress.emit(i, steps)
+      with pool.write() as db:
+        m, n = compact_chunk(db, *chunk)
+      before += m
+      n_rows += n
+    msg = f"Grouped {before} statistic entries into {n_rows}."
+
+    with pool.read() as db:
+      mode = db.fetchone("pragma auto_vacuum", (0,))[0]
+      free = db.fetchone("pragma freelist_count", (0,))[0]
+      page = db.fetchone("pragma page_size", (4096,))[0]
+
+    if mode != INCREMENTAL:
+      if not self._convert:
+        self.signals.progress.emit(steps, steps)
+        return msg
+      self.signals.progress.emit(len(chunks), steps)
+      with pool.write() as db:
+        db.execute("pragma auto_vacuum = incremental")
+        db.execute("vacuum")  # Needed once for the new mode to take effect.
+      self.signals.progress.emit(steps, steps)
+      return msg + " Switched the database to incremental vacuuming."
+
+    steps = len(chunks) + max(1, math.ceil(free / self._vacuum_pages))
+    reclaimed = done = 0
+    while free > 0:
+      self.signals.progress.emit(len(chunks) + done, steps)
+      with pool.write() as db:
+        db.fetchall("pragma incremental_vacuum(%d)" % self._vacuum_pages)
+        left = db.fetchone("pragma freelist_count", (0,))[0]
+      if left >= free:
+        break  # Nothing more to give back (e.g. another connection holds a read lock on the pages).
+      reclaimed += free - left
+      free = left
+      done += 1
+    self.signals.progress.emit(steps, steps)
+    return msg + f" Reclaimed {reclaimed * page / 1e6:.1f} MB."
+
+
+class TextIndexerSignals(QObject):
+  done = pyqtSignal(int)
+
+
+class TextIndexer(QRunnable):
+  """Adds the enabled texts missing from the word index (see
+  `AmphDatabase.indexTexts()`) in a worker thread, `batch` texts per write
+  transaction. Emits `signals.done` with the number of texts indexed. Setting
+  `cancelled` makes it stop after the current batch."""
+
+  def __init__(self, db, batch=200):
+    super().__init__()
+    self.signals = TextIndexerSignals()
+    self.cancelled = False
+    self._db = db
+    self._batch = batch
+
+  def run(self):
+    t0 = time.time()
+    n = after = 0
+    try:
+      pool = self._db.pool()
+      while not self.cancelled:
+        with pool.write() as db:
+          db.execute("begin immediate")  # It reads, then writes what it read.
+          k, after = db.indexTexts(after, self._batch)
+        if not k:
+          break
+        n += k
+    except Exception:
+      log.exception("indexing texts failed")
+    if n:
+      log.info("indexed the words of %d texts in %.1fs", n, time.time() - t0)
+    self.signals.done.emit(n)
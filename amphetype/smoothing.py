@@ -0,0 +1,74 @@
+"""Smoothing and moving statistics for plotted series.
+
+All functions take 1-d array-likes and return NumPy arrays. The windowed ones
+return one value per complete window of `n` values, i.e. `len(y) - n + 1` of
+them; the exponentially weighted average returns one value per input.
+
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Maximum number of values the rolling order statistics process at once.
+_BLOCK = 1 << 20
+
+
+def moving_average(y, n):
+  "Simple moving average of each window of `n` values."
+  y = np.asarray(y, dtype=np.float64)
+  n = max(1, int(n))
+  if len(y) < n:
+    return np.empty(0)
+  # Centering first keeps the running sums, and so their rounding errors, small.
+  m = y.mean()
+  c = np.cumsum(np.r_[0.0, y - m])
+  return (c[n:] - c[:-n]) / n + m
+
+
+def ewma(y, span):
+  """Exponentially weighted moving average with smoothing factor
+  `2 / (span + 1)`, starting from the first value."""
+  y = np.asarray(y, dtype=np.float64)
+  if len(y) == 0:
+    return np.empty(0)
+  a = 2.0 / (max(1.0, float(span)) + 1.0)
+  if a >= 1.0:
+    return y.copy()
+  # Closed form: s[p+t] = (1-a)^t * (s[p] + sum_{i=1..t} a * y[p+i] / (1-a)^i).
+  # The growing powers would overflow, so evaluate it in blocks short enough
+  # for them to stay finite, carrying the last value over.
+  block = max(1, int(500.0 / -np.log1p(-a)))
+  out = np.empty_like(y)
+  out[0] = y[0]
+  for s in range(1, len(y), block):
+    chunk = y[s : s + block]
+    decay = (1.0 - a) ** np.arange(1, len(chunk) + 1)
+    out[s : s + len(chunk)] = decay * (out[s - 1] + np.cumsum(a * chunk / decay))
+  return out
+
+
+def rolling_quantile(y, n, q):
+  """The `q`-quantile(s) (linearly interpolated, like `Data.quantile`) of each
+  window of `n` values. With a sequence `q` returns one row per quantile."""
+  y = np.asarray(y, dtype=np.float64)
+  n = max(1, int(n))
+  scalar = np.ndim(q) == 0
+  if len(y) < n:
+    return np.empty(0) if scalar else np.empty((len(np.atleast_1d(q)), 0))
+  windows = sliding_window_view(y, n)
+  step = max(1, _BLOCK // n)
+  res = np.concatenate(
+    [np.atleast_2d(np.quantile(windows[i : i + step], q, axis=1)) for i in range(0, len(windows), step)], axis=1
+  )
+  return res[0] if scalar else res
+
+
+def rolling_median(y, n):
+  "Median of each window of `n` values."
+  return rolling_quantile(y, n, 0.5)
+
+
+def bands(y, n, lo=0.25, hi=0.75):
+  "The `lo` and `hi` quantiles of each window of `n` values, as a pair of arrays."
+  res = rolling_quantile(y, n, [lo, hi])
+  return res[0], res[1]
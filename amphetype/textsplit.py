@@ -0,0 +1,201 @@
+"""Splitting of plain text into sentences and lessons.
+
+Kept free of Qt and settings so it can run in worker processes (see
+`mine_file()`); `amphetype.Text` wraps it for the GUI.
+
+"""
+
+import hashlib
+import os
+import re
+
+# fmt: off
+abbreviations = set(
+  map(
+    str,
+    [
+      "jr", "mr", "mrs", "ms", "dr", "prof", "sr", "sen", "rep", "sens", "reps", "gov", "attys", "atty", "supt", "det",
+      "rev", "col", "gen", "lt", "cmdr", "adm", "capt", "sgt", "cpl", "maj", "dept", "univ", "assn", "bros", "inc",
+      "ltd", "co", "corp", "arc", "al", "ave", "blvd", "bld", "cl", "ct", "cres", "dr", "expy", "exp", "dist", "mt",
+      "ft", "fwy", "fy", "hway", "hwy", "la", "pde", "pd", "pl", "plz", "rd", "st", "tce", "Ala", "Ariz", "Ark", "Cal",
+      "Calif", "Col", "Colo", "Conn", "Del", "Fed", "Fla", "Ga", "Ida", "Id", "Ill", "Ind", "Ia", "Kan", "Kans", "Ken",
+      "Ky", "La", "Me", "Md", "Is", "Mass", "Mich", "Minn", "Miss", "Mo", "Mont", "Neb", "Nebr", "Nev", "Mex", "Okla",
+      "Ok", "Ore","Penna", "Penn", "Pa", "Dak", "Tenn", "Tex", "Ut", "Vt", "Va", "Wash", "Wis", "Wisc", "Wy", "Wyo",
+      "USAFA", "Alta", "Man", "Ont", "Qué", "Sask", "Yuk", "jan", "feb", "mar", "apr", "may", "jun", "jul", "aug",
+      "sep", "oct", "nov", "dec", "sept", "vs","etc", "no", "esp", "eg", "ie", "1", "2", "3", "4", "5", "6", "7", "8",
+      "9", "10", "11", "12", "avg", "viz", "m", "mme",
+    ],
+  )
+)
+# fmt: on
+
+
+class SentenceSplitter(object):
+  sen = re.compile(r"""(?:(?: |^)[^\w. ]*(?P<pre>\w+)[^ .]*\.+|[?!]+)['"]?(?= +(?:[^ a-z]|$))|$""")
+
+  def __init__(self, text):
+    self.string = text
+
+  def __iter__(self):
+    p = [0]
+    return filter(None, map(lambda x: self.pars(p, x), self.sen.finditer(self.string)))
+
+  def pars(self, p, mat):
+    if mat.group("pre") and self.isAbbreviation(mat.group("pre")):
+      return None
+    p.append(mat.end())
+    return self.string[p[-2] : p[-1]].strip()
+
+  def isAbbreviation(self, s):
+    ls = s.lower()
+    return ls in abbreviations or s in abbreviations
+
+
+def text_id(text):
+  "Database id of a text (hex SHA-1 of its UTF-8 encoding)."
+  return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def paragraphs(fname, progress=None):
+  """Generates a `SentenceSplitter` per paragraph (block of non-empty lines) of
+  a UTF-8 file, reading it lazily. `progress` is called with the percentage of
+  the file consumed whenever it changes."""
+  size = os.path.getsize(fname)
+  pct = -1
+  p = []
+  # Universal newlines, so "\r"-only files are split into lines too.
+  with open(fname, "r", encoding="utf-8-sig") as f:
+    for line in f:
+      line = line.strip()
+      if line != "":
+        p.append(line)
+      elif len(p) > 0:
+        yield SentenceSplitter(" ".join(p))
+        p = []
+        # The position of the underlying binary buffer is read-ahead, but
+        # close enough for a progress bar.
+        pos = f.buffer.tell()
+        if progress is not None and 100 * pos // max(size, 1) != pct:
+          pct = 100 * pos // max(size, 1)
+          progress(pct)
+  if len(p) > 0:
+    yield SentenceSplitter(" ".join(p))
+  if progress is not None:
+    progress(100)
+
+
+def pop_format(lst):
+  "Joins sentences in `lst` into a lesson, with None marking paragraph breaks, and clears `lst`."
+  ret = []
+  p = []
+  for s in lst:
+    if s is not None:
+      p.append(s)
+    else:
+      ret.append(" ".join(p))
+      p = []
+  lst.clear()
+  if len(p) > 0:
+    ret.append(" ".join(p))
+  return "\n".join(ret)
+
+
+def mine_lessons(fname, min_chars, max_chars, break_sentences=False, progress=None):
+  "Generates the lessons of a text file; see `paragraphs()`."
+  backlog = []
+  backlen = 0
+  for p in paragraphs(fname, progress):
+    if len(backlog) > 0:
+      backlog.append(None)
+    for s in to_lessons(iter(p), min_chars, max_chars) if break_sentences else p:
+      backlog.append(s)
+      backlen += len(s)
+      if backlen >= min_chars:
+        yield pop_format(backlog)
+        backlen = 0
+  if backlen > 0:
+    yield pop_format(backlog)
+
+
+# Where `mine_file()` sends its lessons; set in each worker by `init_worker()`.
+_results = None
+
+
+def init_worker(results):
+  global _results
+  _results = results
+
+
+def mine_file(tag, fname, min_chars, max_chars, break_sentences=False, chunk_size=500):
+  """Puts the lessons of a file on the worker's results queue as `(tag,
+  [(text_id, lesson)])` chunks of at most `chunk_size`, followed by `(tag,
+  None)` when done (also if it failed). Meant to be run in a worker process;
+  with a bounded queue only a few chunks are ever held in memory."""
+  try:
+    chunk = []
+    for x in mine_lessons(fname, min_chars, max_chars, break_sentences):
+      chunk.append((text_id(x), x))
+      if len(chunk) >= chunk_size:
+        _results.put((tag, chunk))
+        chunk = []
+    if chunk:
+      _results.put((tag, chunk))
+  finally:
+    _results.put((tag, None))
+
+
+def find_relative(s, c, idx):
+  """Given a string `s` and a char/substring `c`, find a location of `c` that is
+  as close as possible to `idx`.
+
+  Returns -1 if no `c` is found in `s`.
+
+  """
+  a, b = s.find(" ", idx), s.rfind(" ", idx)
+  if a == -1:
+    return b
+  if b == -1:
+    return a
+  return min((a, b), key=lambda x: abs(x - idx))
+
+
+def split_sentence(s, sweet_spot):
+  """Generator that break sentence `s` into pieces (on spaces and linebreaks) that
+  are around `sweet_spot` in length.
+
+  """
+  while len(s) > sweet_spot:
+    idx = find_relative(s.replace("\n", " "), " ", sweet_spot)
+    if idx == -1:
+      break
+    yield s[:idx]
+    s = s[idx + 1 :]
+  if s:
+    yield s
+
+
+def to_lessons(sentences, min_chars, max_chars):
+  backlog = []
+  backlen = 0
+  # Sanity/robustness.
+  min_chars = max(min_chars, 1)
+  max_chars = min(max_chars, 99999)
+  if min_chars > max_chars:
+    min_chars, max_chars = max_chars, min_chars
+
+  # This is a little arbitrary, and just aesthetics, but if a sentence is so
+  # long that its ratio to the "total range" exceeds the golden ratio, then it
+  # will be broken up. Otherwise we prefer to leave sentences alone and treat
+  # them as atomic units.
+  sweet_spot = min_chars + int((max_chars - min_chars) / 1.618033988749895)
+
+  for s in sentences:
+    for part in split_sentence(s, sweet_spot):
+      backlog.append(part)
+      backlen += len(part)
+      if backlen >= min_chars:
+        yield " ".join(backlog)  # XXX: French 2-space etc.?
+        backlog = []
+        backlen = 0
+  if backlen > 0:
+    yield " ".join(backlog)  # XXX: French 2-space etc.?
@@ -1,5 +1,6 @@
 import logging as log
 import re
+from array import array
 
 from amphetype import timer
 
@@ -8,144 +9,91 @@ def median(lst):
   lst, n = sorted(lst), len(lst)
   if not n:
     return None
-  res = lst[n // 2]
   if n % 2 == 0:
-    res += lst[n // 2 + 1]
-    res /= 2.0
-  return res
+    return (lst[n // 2 - 1] + lst[n // 2]) / 2.0
+  return lst[n // 2]
 
 
-class datatuple(tuple):
-  def __getattr__(self, key):
-    return tuple(getattr(x, key) for x in self)
+NAN = float("nan")
 
-  def __getitem__(self, idx):
-    if isinstance(idx, tuple):
-      return type(self)(x for (x, cond) in zip(self, idx))
-    if isinstance(idx, list):
-      return type(self)(self[i] for i in idx)
-    res = super().__getitem__(idx)
-    if isinstance(idx, slice):
-      return type(self)(res)
-    return res
-
-  def split(self, pred):
-    if not callable(pred):
-      pred = lambda x, y=pred: x == y
-
-    cur = []
-    for x in self:
-      if pred(x):
-        yield type(self)(cur)
-        cur = []
-      else:
-        cur.append(x)
-    yield type(self)(cur)
 
+def _is_set(t):
+  return t == t  # False only for NaN, which marks a missing time.
 
-class CharEntry:
-  __slots__ = ("char", "inserts", "timing", "mistakes", "first", "first_any", "last", "errors")
 
-  def __init__(self, char):
-    self.char = char
-    self.inserts = 0
-    self.first = None
-    self.first_any = None
-    self.last = None
-    self.timing = None
-    self.mistakes = 0
-    self.errors = ""
+def _timed(ts):
+  """Valid (set and non-zero) timings in `ts`."""
+  return [t for t in ts if t == t and t]
 
-  def visited(self):
-    return self.first is not None
 
-  def visit(self, correct, last_time):
-    now = timer()
+class RunView:
+  """Read-only window `[start, stop)` into the columns of a `RunStats`.
 
-    if self.first_any is None:
-      self.first_any = now
+  Nothing is copied: the column properties return memoryviews into the parent
+  run's arrays.
 
-    if correct:
-      self.last = now
-      if self.first is None:
-        self.first = now
-      if self.timing is None and last_time is not None:
-        self.timing = self.first - last_time
-    else:
-      self.mistakes += 1
+  """
 
-  def __repr__(self):
-    return f'["{self.char}"+{self.inserts} {self.timing or -1:.2f}s m:{self.mistakes}]'
+  def __init__(self, run, start, stop):
+    self.run = run
+    self.start = start
+    self.stop = stop
 
+  def __len__(self):
+    return self.stop - self.start
 
-class RunStats(datatuple):
-  @staticmethod
-  def make(text, started=None):
-    assert len(text) > 0
-    obj = RunStats(CharEntry(c) for c in text)
-    obj.started = started
-    return obj
-
-  def __new__(cls, cs):
-    self = datatuple.__new__(cls, cs)
-    idx = 0
-    while idx < len(self) and self[idx].last is not None:
-      idx += 1
-    self.index = idx
-    self.started = None
-    return self
+  def __getitem__(self, idx):
+    if not isinstance(idx, slice):
+      raise TypeError("RunView only supports slicing")
+    s, e, d = idx.indices(len(self))
+    assert d == 1
+    return RunView(self.run, self.start + s, self.start + max(s, e))
 
   def __repr__(self):
-    return "\n".join(
-      [
-        " ".join([f"{c.char:^5s}" for c in self]),
-        " ".join([f"{c.timing or -1:5.2f}" for c in self]),
-      ]
-    )
+    return f'<RunView "{self.text}" [{self.start}:{self.stop}]>'
+
+  @property
+  def started(self):
+    if self.start == 0:
+      return self.run.started
+    t = self.run._last[self.start - 1]
+    return t if _is_set(t) else None
 
   def is_complete(self):
-    return self.index >= len(self) and self.previous and self.previous.last is not None
+    return all(_is_set(t) for t in self.last)
 
-  def has_started(self):
-    return self.started is not None
+  @property
+  def text(self):
+    return self.run._text[self.start : self.stop]
 
   @property
-  def current(self):
-    if self.index >= len(self):
-      return None
-    return self[self.index]
+  def timing(self):
+    return memoryview(self.run._timing)[self.start : self.stop]
 
   @property
-  def previous(self):
-    if self.index == 0:
-      return None
-    return self[self.index - 1]
+  def last(self):
+    return memoryview(self.run._last)[self.start : self.stop]
 
   @property
-  def next(self):
-    if self.index >= len(self) - 1:
-      return None
-    return self[self.index + 1]
+  def mistakes(self):
+    return memoryview(self.run._mistakes)[self.start : self.stop]
 
   @property
-  def ending(self):
-    return self.index >= len(self) - 1
+  def errors(self):
+    return self.run._errors[self.start : self.stop]
 
   @property
   def start_end(self):
     if not len(self):
       return (None, None)
-    return self.started, self[-1].last
-
-  @property
-  def text(self):
-    return "".join(self.char)
+    t = self.run._last[self.stop - 1]
+    return self.started, t if _is_set(t) else None
 
   @property
   def duration(self):
     if self.started is None or not self.is_complete():
       return None
-    return self.previous.last - self.started
+    return self.run._last[self.stop - 1] - self.started
 
   @property
   def per_sec(self):
@@ -153,41 +101,164 @@ class RunStats(datatuple):
       return None
     return len(self) / self.duration
 
-  def __getitem__(self, idx):
-    res = super().__getitem__(idx)
-    if isinstance(idx, slice):
-      s, e, d = idx.indices(len(self))
-      assert d > 0
-      if s - d == -1:
-        res.started = self.started
-      elif 0 <= s - d < len(self):
-        res.started = self[s - d].last
-    return res
+  @property
+  def median_timing(self):
+    return median(_timed(self.timing))
+
+  @property
+  def faults(self):
+    return sum(1 for m in self.mistakes if m > 0)
+
+  @property
+  def visc(self):
+    # Bad, do something else?
+    # mean = sum(xs)/len(xs)
+    # return sum([(x/mean - 1.0)**2 for x in xs])
+
+    # Experimental new viscosity.
+    xs = _timed(self.timing)
+    if len(xs) < 3:
+      return None
+    return self.median_err(median(xs))
+
+  def median_err(self, m):
+    return sum([(max(0, t - m)) ** 2 for t in _timed(self.timing)])
+
+  def result(self, accuracy=False):
+    acc = 1.0 - self.faults / len(self) if accuracy else self.faults != 0
+    return self.per_sec * 12.0, self.visc, acc
+
+  @property
+  def stats(self):
+    return None if self.per_sec is None else 1.0 / self.per_sec, self.visc, self.faults != 0
+
+  def ngram_spans(self, n):
+    return ((i - n, i) for i in range(n, len(self)))
+
+  def word_spans(self):
+    for m in re.finditer(r"\w+(?:['-]\w+)*", self.text):
+      if m.end() - m.start() >= 4:
+        yield m.span()
+
+  def timed_ngrams(self, n, complete=True):
+    for s, e in self.ngram_spans(n):
+      gram = self[s:e]
+      if not complete or gram.is_complete():
+        yield gram
+
+  def timed_words(self, complete=True):
+    for s, e in self.word_spans():
+      word = self[s:e]
+      if not complete or word.is_complete():
+        yield word
+
+
+class RunStats(RunView):
+  """Timing data for a single run through `text`, stored column-wise.
+
+  Per character: time of first correct input (`first`), of first input of any
+  kind (`first_any`), of last correct input (`last`), the time it took
+  (`timing`), the number of mistakes and of extra (inserted) characters, and the
+  wrong characters typed (`errors`). Missing times are NaN.
+
+  """
+
+  @staticmethod
+  def make(text, started=None):
+    assert len(text) > 0
+    return RunStats(text, started)
+
+  def __init__(self, text, started=None):
+    n = len(text)
+    super().__init__(self, 0, n)
+    self._text = text
+    self._first = array("d", [NAN]) * n
+    self._first_any = array("d", [NAN]) * n
+    self._last = array("d", [NAN]) * n
+    self._timing = array("d", [NAN]) * n
+    self._mistakes = array("i", [0]) * n
+    self._inserts = array("i", [0]) * n
+    self._errors = [""] * n
+    self.index = 0
+    self._started = started
+
+  def __repr__(self):
+    return "\n".join(
+      [
+        " ".join([f"{c:^5s}" for c in self.text]),
+        " ".join([f"{t if _is_set(t) else -1:5.2f}" for t in self.timing]),
+      ]
+    )
+
+  @property
+  def started(self):
+    return self._started
+
+  @started.setter
+  def started(self, t):
+    self._started = t
+
+  def is_complete(self):
+    return self.index >= len(self) and _is_set(self._last[self.index - 1])
+
+  def has_started(self):
+    return self.started is not None
+
+  @property
+  def current(self):
+    """The character to be typed next, or None at the end."""
+    if self.index >= len(self):
+      return None
+    return self._text[self.index]
+
+  @property
+  def ending(self):
+    return self.index >= len(self) - 1
 
   def last_was_error(self):
-    if self.current and self.current.inserts > 0:
+    if self.index < len(self) and self._inserts[self.index] > 0:
       return True
-    if self.previous and self.previous.last is None:
+    if self.index > 0 and not _is_set(self._last[self.index - 1]):
       return True
     return False
 
+  def add_error(self, char):
+    self._errors[self.index] += char
+
   def pop_char(self):
-    if self.current is None or self.current.inserts == 0:
+    i = self.index
+    if i >= len(self) or self._inserts[i] == 0:
       self.index -= 1
-      return self.current.char
-    if self.current.inserts > 0:
-      self.current.inserts -= 1
+      return self._text[self.index]
+    self._inserts[i] -= 1
     return None
 
   def visit(self, correct):
-    if self.previous:
-      self.current.visit(correct, self.previous.last)
+    i = self.index
+    if i > 0:
+      last_time = self._last[i - 1]
+      if not _is_set(last_time):
+        last_time = None
+    else:
+      last_time = self.started
+
+    now = timer()
+
+    if not _is_set(self._first_any[i]):
+      self._first_any[i] = now
+
+    if correct:
+      self._last[i] = now
+      if not _is_set(self._first[i]):
+        self._first[i] = now
+      if not _is_set(self._timing[i]) and last_time is not None:
+        self._timing[i] = self._first[i] - last_time
     else:
-      self.current.visit(correct, self.started)
+      self._mistakes[i] += 1
 
   def advance(self, real=True):
     if not real:
-      self.current.inserts += 1
+      self._inserts[self.index] += 1
       return
 
     self.index += 1
@@ -201,7 +272,7 @@ class RunStats(datatuple):
       return
 
     i = 0
-    while i < len(self) and self[i].last is None:
+    while i < len(self) and not _is_set(self._last[i]):
       i += 1
 
     med = self.median_timing
@@ -209,51 +280,40 @@ class RunStats(datatuple):
       log.error(f"cannot fixup broken run, all times are invalid:\n{self}")
       return
 
-    self.started = self[i].last - (i + 1) * med
-
-  @property
-  def median_timing(self):
-    return median([t for t in self.timing if t])
-
-  @property
-  def faults(self):
-    return sum(1 for c in self if c.mistakes > 0)
-
-  @property
-  def visc(self):
-    # Bad, do something else?
-    # mean = sum(xs)/len(xs)
-    # return sum([(x/mean - 1.0)**2 for x in xs])
-
-    # Experimental new viscosity.
-    xs = [t for t in self.timing if t]
-    if len(xs) < 3:
-      return None
-    return self.median_err(median(xs))
-
-  def median_err(self, m):
-    return sum([(max(0, x.timing - m)) ** 2 for x in self if x.timing])
-
-  def result(self, accuracy=False):
-    # print(f'"{self.text}" {self.started=}, {self.duration=}, {self.previous=}, {self.per_sec=}')
-    acc = 1.0 - self.faults / len(self) if accuracy else self.faults != 0
-    return self.per_sec * 12.0, self.visc, acc
-
-  @property
-  def stats(self):
-    return None if self.per_sec is None else 1.0 / self.per_sec, self.visc, self.faults != 0
-
-  def timed_ngrams(self, n, complete=True):
-    for i in range(n, len(self)):
-      gram = self[i - n : i]
-      if not complete or gram.is_complete():
-        yield gram
-
-  def timed_words(self, complete=True):
-    for m in re.finditer(r"\w+(?:['-]\w+)*", self.text):
-      word = self[m.start() : m.end()]
-      if len(word) >= 4 and (not complete or word.is_complete()):
-        yield word
+    self.started = self._last[i] - (i + 1) * med
+
+  def span_stats(self, spans):
+    """Yields `(start, stop, secs_per_char, visc, flawed)` for every complete
+    window `[start, stop)` in `spans`.
+
+    Same numbers as `self[start:stop].stats`, but completeness and faults come
+    from prefix sums computed in one pass over the run, so a window only costs
+    a sort of its own timings (for the viscosity).
+
+    """
+    n = len(self)
+    last = self._last
+    unset = [0] * (n + 1)
+    faulty = [0] * (n + 1)
+    for i in range(n):
+      unset[i + 1] = unset[i] + (last[i] != last[i])
+      faulty[i + 1] = faulty[i] + (self._mistakes[i] > 0)
+    timing = self._timing.tolist()
+
+    for s, e in spans:
+      if unset[e] != unset[s]:
+        continue
+      started = self.started if s == 0 else last[s - 1]
+      if started is None or started != started:
+        spc = None
+      else:
+        spc = 1.0 / ((e - s) / (last[e - 1] - started))
+      xs = _timed(timing[s:e])
+      visc = None
+      if len(xs) >= 3:
+        m = median(xs)
+        visc = sum([(max(0, t - m)) ** 2 for t in xs])
+      yield s, e, spc, visc, faulty[e] != faulty[s]
 
 
 # Speedbumps:
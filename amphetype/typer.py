@@ -1,14 +1,16 @@
 import logging as log
+import sqlite3
 from collections import Counter, defaultdict
-from time import time
+from time import sleep, time
 
-from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtCore import QObject, QRunnable, Qt, QThreadPool, pyqtSignal
 from PyQt5.QtGui import QBrush, QColor, QTextBlockFormat, QTextCharFormat, QTextCursor, QTextDocument
 from PyQt5.QtWidgets import QApplication, QLabel, QProgressBar, QSizePolicy, QTextEdit, QWidget
 
-from amphetype import timer
+from amphetype import latency, timer
 from amphetype.Data import Statistic
 from amphetype.fwidgets import FStackedWidget
+from amphetype.latency import LatencyOverlay, timed
 from amphetype.layout import FBoxLayout
 from amphetype.timingtuple import RunStats
 
@@ -188,6 +190,7 @@ class LessonDocument(QTextDocument):
     self._run = RunStats.make(self._match_text, timer())
     self.started.emit()
 
+  @timed("insert")
   def insert(self, char, overwrite=True, lenient=False):
     if self._run is None:
       # Cold start.
@@ -197,7 +200,7 @@ class LessonDocument(QTextDocument):
     if self._run.current is None:
       return
 
-    correct = char == self._run.current.char
+    correct = char == self._run.current
     should_advance = correct or overwrite
 
     if self._first_error is not None:
@@ -213,7 +216,7 @@ class LessonDocument(QTextDocument):
     if correct:
       self.progress.emit(self._run.index)
     else:
-      self._run.current.errors += char
+      self._run.add_error(char)
       if not lenient:
         self._first_error = Cursor(self.cursor, fixed=True)
 
@@ -228,6 +231,7 @@ class LessonDocument(QTextDocument):
     else:
       self.sig_position.emit(self.cursor)
 
+  @timed("actual_insert")
   def actual_insert(self, char, style, overwrite=True):
     self.cursor.insertText(char, style)
     if overwrite:
@@ -235,6 +239,7 @@ class LessonDocument(QTextDocument):
     if self.cursor.atBlockEnd() and not (self._run and self._run.ending):
       self.cursor.movePosition(QTextCursor.NextCharacter)
 
+  @timed("backspace")
   def backspace(self, by_word=False, protected=False):
     if not self.is_running():
       return
@@ -279,6 +284,119 @@ class LessonDocument(QTextDocument):
     self.sig_position.emit(self.cursor)
 
 
+### STATISTICS
+
+
+def ngram_type(n):
+  """The `statistic.type` of n-grams of length `n`: 1 for trigrams, which is
+  what the Analysis tab and text selection read, and `10 + n` for the others
+  so that different lengths never mix."""
+  return 1 if n == 3 else 10 + n
+
+
+def run_statistics(run, now, ngram=3):
+  """Extracts per-key, per-n-gram (of length `ngram`) and per-word statistics
+  from a completed run.
+
+  Returns `(vals, mistakes)` where `vals` are rows for `AmphDatabase.addStatistics()`
+  and `mistakes` rows for the `mistake` table.
+
+  """
+  med_char = run.median_timing
+
+  stats = defaultdict(Statistic)
+  visc = defaultdict(Statistic)
+
+  # Collect per-char. Incomplete windows are skipped by span_stats().
+  for s, e, spc, _, flaw in run.span_stats((i, i + 1) for i in range(len(run))):
+    if spc is None:
+      log.info(f"skipping {run.text[s]} char statistic: {run[s:e].start_end}")
+      continue
+    stats[0, run.text[s]].append(spc, flaw)
+    visc[0, run.text[s]].append(run[s:e].median_err(med_char))
+
+  # type (0: char, ngram_type(ngram): n-gram, 2: word)
+  for tp, spans in [(ngram_type(ngram), run.ngram_spans(ngram)), (2, run.word_spans())]:
+    for s, e, spc, vc, flaw in run.span_stats(spans):
+      # Viscosity needs three timings, so bigrams are stored without it.
+      if spc is None or (vc is None and e - s >= 3):
+        log.info(f"skipping {run.text[s:e]} statistic (type {tp}): {run[s:e].start_end}")
+        continue
+      stats[tp, run.text[s:e]].append(spc, flaw)
+      if vc is not None:
+        visc[tp, run.text[s:e]].append(vc)
+
+  # time, visc, now, count, mistakes, type, data
+
+  vals = []
+  for (tp, k), s in stats.items():
+    v = visc[tp, k].median()
+    if v is not None:
+      v *= 100.0
+    vals.append((s.median(), v, now, len(s), s.flawed(), tp, k))
+
+  mistakes = Counter((c, e) for c, m, es in zip(run.text, run.mistakes, run.errors, strict=True) if m > 0 for e in es)
+  return vals, [(now, k[0], k[1], v) for k, v in mistakes.items()]
+
+
+class StatsWriterSignals(QObject):
+  done = pyqtSignal("PyQt_PyObject")
+  failed = pyqtSignal(str)
+
+
+class StatsWriter(QRunnable):
+  """Computes and stores the statistics of a finished run in a worker thread,
+  using the writer connection of the database's pool. Emits `signals.done` with the statistic
+  rows when finished (an empty list if they couldn't be computed), preceded by
+  `signals.failed` with the error if they couldn't be computed or stored.
+
+  A locked database is retried `retries` times before giving up.
+
+  """
+
+  retries = 3
+
+  def __init__(self, db, run, now, save=True, ngram=3):
+    super().__init__()
+    self.signals = StatsWriterSignals()
+    self._db = db
+    self._run = run
+    self._now = now
+    self._save = save
+    self._ngram = ngram
+
+  def run(self):
+    vals = []
+    try:
+      vals, mistakes = run_statistics(self._run, self._now, self._ngram)
+      if self._save:
+        self.store(vals, mistakes)
+    except Exception as e:
+      log.exception("failed to store statistics for run")
+      self.signals.failed.emit(str(e))
+    self.signals.done.emit(vals)
+
+  def store(self, vals, mistakes):
+    for attempt in range(self.retries + 1):
+      try:
+        with self._db.pool().write() as db:
+          db.addStatistics(vals)
+          db.executemany_(
+            """
+          insert into mistake
+          (w,target,mistake,count)
+          values (?,?,?,?)
+          """,
+            mistakes,
+          )
+        return
+      except sqlite3.OperationalError as e:
+        if attempt == self.retries:
+          raise
+        log.warning("storing statistics failed (%s), retrying", e)
+        sleep(1.0 + attempt)
+
+
 ### WIDGET
 
 
@@ -328,6 +446,12 @@ class TyperWidget(QTextEdit):
     lesson.completed.connect(self.updateStatus)
     self._lesson = lesson
 
+  if latency.recorder is not None:
+    # Only worth the extra Python call when it's being measured.
+    @timed("setTextCursor")
+    def setTextCursor(self, cursor):
+      super().setTextCursor(cursor)
+
   def updateStatus(self):
     if self._lesson is None:
       return
@@ -340,6 +464,7 @@ class TyperWidget(QTextEdit):
   def mouseReleaseEvent(self, e):
     pass
 
+  @timed("keystroke (Typer 2)")
   def keyPressEvent(self, evt):
     if not self._lesson:
       evt.ignore()
@@ -390,8 +515,13 @@ class TyperWindow(QWidget):
     self.S = app.settings.typer_settings
     self.DB = app.DB
 
+    # Single thread so that statistics are written in the order runs finish.
+    self._writer = QThreadPool(self, maxThreadCount=1)
+    self._writes = set()  # Keeps pending writers (and their signals) alive.
+
     self._current_lesson = None
     self._typer = TyperWidget(self.S)
+    self._latency = LatencyOverlay(self._typer)
     hack = QSizePolicy(QSizePolicy.Minimum, QSizePolicy.Ignored)
     self._label = QLabel(wordWrap=True, sizePolicy=hack)
     self._prog = QProgressBar()
@@ -521,79 +651,13 @@ class TyperWindow(QWidget):
       )
       self.updateLabel("Last: %.1fwpm (%.1f%%), last 10 average: %.1fwpm (%.1f%%)" % ((wpm, 100.0 * acc) + v2))
 
-    self.DB.commit()
-    # type (0: char, 1: trigram, 2: word)
-
-    stats = defaultdict(Statistic)
-    visc = defaultdict(Statistic)
-
-    # Collect per-char.
-    for i in range(len(run)):
-      sub = run[i : i + 1]
-      spc, _, flaw = sub.stats
-      if spc is None:
-        log.info(f"skipping {sub.text} char statistic: {sub.start_end}")
-        continue
-      stats[sub.text].append(spc, flaw)
-      visc[sub.text].append(sub.median_err(med_char))
-
-    for sub in run.timed_ngrams(3):
-      spc, vc, flaw = sub.stats
-      if spc is None or vc is None:
-        log.info(f"skipping {sub.text} trigram statistic: {sub.start_end}")
-        continue
-      stats[sub.text].append(spc, flaw)
-      visc[sub.text].append(vc)
-
-    for sub in run.timed_words():
-      spc, vc, flaw = sub.stats
-      if spc is None or vc is None:
-        log.info(f"skipping {sub.text} word statistic: {sub.start_end}")
-        continue
-      stats[sub.text].append(spc, flaw)
-      visc[sub.text].append(vc)
-
-    # time, visc, now, count, mistakes, type, data
-
-    vals = []
-    for k, s in stats.items():
-      v = visc[k].median()
-      if v is not None:
-        v *= 100.0
-      tp = 2
-      if len(k) == 3:
-        tp = 1
-      elif len(k) == 1:
-        tp = 0
-      vals.append((s.median(), v, now, len(s), s.flawed(), tp, k))
-
-    # print(vals)
-
     is_lesson = self.DB.fetchone("select discount from source where rowid=?", (None,), (srcid,))[0]
-
-    if not is_lesson or self._settings.get("use_lesson_stats"):
-      self.DB.executemany_(
-        """
-      insert into statistic
-      (time,viscosity,w,count,mistakes,type,data)
-      values (?,?,?,?,?,?,?)
-      """,
-        vals,
-      )
-
-      mistakes = Counter((c.char, e) for c in run if c.mistakes > 0 for e in c.errors)
-      self.DB.executemany_(
-        """
-      insert into mistake
-      (w,target,mistake,count)
-      values (?,?,?,?)
-      """,
-        [(now, k[0], k[1], v) for k, v in mistakes.items()],
-      )
-
     self.DB.commit()
-    self.statsChanged.emit()
 
+    # The heavy lifting (slicing up the run and storing the statistics) is done
+    # in a worker thread so the GUI stays responsive. The next text is only
+    # asked for once they're stored, as choosing it may depend on them.
+    then = "next"
     if is_lesson:
       mins = self._settings.get("min_lesson_wpm"), self._settings.get("min_lesson_acc")
     else:
@@ -601,16 +665,41 @@ class TyperWindow(QWidget):
 
     if wpm < mins[0] or acc < mins[1] / 100.0:
       self.setText(self._current_lesson)
+      then = None
     elif not is_lesson and self._settings.get("auto_review"):
-      ws = [x for x in vals if x[5] == 2]
-      if len(ws) == 0:
-        self.wantText.emit()
-        return
-      ws.sort(key=lambda x: (x[4], x[0]), reverse=True)
+      then = "review"  # Needs the word statistics; see statsDone().
+
+    writer = StatsWriter(
+      self.DB,
+      run,
+      now,
+      save=not is_lesson or self._settings.get("use_lesson_stats"),
+      ngram=max(2, self._settings.get("ngram_length")),
+    )
+    writer.signals.failed.connect(self.statsFailed)
+    writer.signals.done.connect(lambda vals: self.statsDone(writer, vals, then))
+    self._writes.add(writer)
+    self._writer.start(writer)
 
-      u = sum(x[4] != 0 for x in ws)
-      u += (len(ws) - u) // 4
+  def statsFailed(self, msg):
+    self.typingFailed(f"The statistics of the last run could not be saved: {msg}")
 
-      self.wantReview.emit([x[6] for x in ws[:u]])
-    else:
+  def statsDone(self, writer, vals, then=None):
+    self._writes.discard(writer)
+    self.statsChanged.emit()
+
+    if then == "next":
+      self.wantText.emit()
+    if then != "review":
+      return
+
+    ws = [x for x in vals if x[5] == 2]
+    if len(ws) == 0:
       self.wantText.emit()
+      return
+    ws.sort(key=lambda x: (x[4], x[0]), reverse=True)
+
+    u = sum(x[4] != 0 for x in ws)
+    u += (len(ws) - u) // 4
+
+    self.wantReview.emit([x[6] for x in ws[:u]])
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 # bootstrap.py - Entry point script for PyInstaller
 
+import multiprocessing
+
 from amphetype.main import main_normal
 
 if __name__ == '__main__':
+    # Needed for the worker processes used when importing texts.
+    multiprocessing.freeze_support()
     main_normal()